@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import Counter
+
+# endpoints that scan whole partitions or fan out to many queries
+expensive_endpoints = {
+    "address_balance",
+    "address_egonet",
+    "address_flows",
+    "block_stats",
+    "cluster_addresses_top",
+    "cluster_egonet",
+    "export",
+    "global_search",
+    "search"
+}
+# paged endpoints, which are expensive for large pages or block ranges
+paged_endpoints = {
+    "address_neighbors",
+    "address_transactions",
+    "blocks",
+    "cluster_addresses",
+    "cluster_neighbors"
+}
+# arguments of the neighbors endpoints that scan whole relation partitions
+neighbor_filter_args = {"minTransactions", "minValue", "sort", "tagged", "top"}
+# arguments resolving or expanding every row with further queries
+expansion_args = {"expand", "resolve"}
+
+
+def is_expensive(endpoint, args, max_cheap_rows):
+    if endpoint in expensive_endpoints or expansion_args.intersection(args):
+        return True
+    if endpoint not in paged_endpoints:
+        return False
+    if endpoint in ("address_neighbors", "cluster_neighbors") and \
+            neighbor_filter_args.intersection(args):
+        return True
+    try:
+        rows = max(int(args.get(name, 0))
+                   for name in ("pagesize", "latest"))
+        if args.get("from") is not None:
+            rows = max(rows, int(args.get("to", 2**62)) - int(args["from"]))
+    except ValueError:
+        return False
+    return rows > max_cheap_rows
+
+
+class AdmissionController(object):
+    def __init__(self, max_requests, max_requests_per_client, max_waiting,
+                 queue_timeout):
+        self.maxRequests = max_requests
+        self.maxRequestsPerClient = max_requests_per_client
+        self.maxWaiting = max_waiting
+        self.queueTimeout = queue_timeout
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.clients = Counter()
+
+    def acquire(self, client):
+        # requests beyond maxRequests, or beyond maxRequestsPerClient of a
+        # single client, wait for a slot up to queueTimeout seconds; at most
+        # maxWaiting requests wait at a time, so that waiting requests do not
+        # occupy the threads left for cheap requests, further ones are
+        # rejected right away
+        deadline = time.time() + self.queueTimeout
+        with self.condition:
+            if not self.available(client):
+                if self.waiting >= self.maxWaiting:
+                    return False
+                self.waiting += 1
+                try:
+                    while not self.available(client):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+            self.clients[client] += 1
+            return True
+
+    def available(self, client):
+        return self.running < self.maxRequests and \
+            self.clients[client] < self.maxRequestsPerClient
+
+    def release(self, client):
+        with self.condition:
+            self.running -= 1
+            self.clients[client] -= 1
+            if not self.clients[client]:
+                del self.clients[client]
+            # waiting requests of other clients may be unable to proceed
+            self.condition.notify_all()
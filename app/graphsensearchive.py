@@ -0,0 +1,141 @@
+import fcntl
+import gzip
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+# Size-bounded archive of the serialized responses of final blocks and
+# transactions on local disk. Files are shared by all workers through the
+# page cache and sent with the server's file wrapper (sendfile in uWSGI);
+# with compression enabled, a gzip copy is kept next to each response and
+# sent to clients accepting it. The total size is kept in a file of the
+# directory, updated under a file lock by all workers.
+
+archived_endpoints = {"block", "block_transactions", "transaction"}
+key_pattern = re.compile(r"^[0-9a-f]+$")
+
+
+class ResponseArchive(object):
+    def __init__(self, directory, max_bytes, compress):
+        self.directory = os.path.abspath(directory)
+        self.maxBytes = max_bytes
+        self.compress = compress
+        self.sizePath = os.path.join(self.directory, "size")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.writes = 0
+        os.makedirs(self.directory, exist_ok=True)
+        with self.shared_size() as fp:
+            self.size = sum(size for (_, size, _) in self.files())
+            write_size(fp, self.size)
+
+    @contextmanager
+    def shared_size(self):
+        with self.lock, open(self.sizePath, "a+") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield fp
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def files(self):
+        for (root, _, names) in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp") or path == self.sizePath:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def path(self, currency, endpoint, key):
+        if not key_pattern.match(key):
+            return None
+        return os.path.join(self.directory, currency, endpoint, key + ".json")
+
+    def lookup(self, currency, endpoint, key, accept_gzip):
+        # returns the path of the stored response and its content encoding
+        path = self.path(currency, endpoint, key)
+        if path is None:
+            return None
+        if accept_gzip and os.path.exists(path + ".gz"):
+            self.hits += 1
+            return path + ".gz", "gzip"
+        if os.path.exists(path):
+            self.hits += 1
+            return path, None
+        return None
+
+    def put(self, currency, endpoint, key, data):
+        path = self.path(currency, endpoint, key)
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        contents = [(path, data)]
+        if self.compress:
+            contents.append((path + ".gz", gzip.compress(data)))
+        added = 0
+        for (target, content) in contents:
+            # written under a temporary name, so other workers never send
+            # partial files
+            temporary = "%s.%d.tmp" % (target, os.getpid())
+            with open(temporary, "wb") as fp:
+                fp.write(content)
+            try:
+                added -= os.stat(target).st_size
+            except OSError:
+                pass
+            os.rename(temporary, target)
+            added += len(content)
+        with self.shared_size() as fp:
+            size = read_size(fp) + added
+            if size > self.maxBytes:
+                size = self.evict()
+            write_size(fp, size)
+            self.size = size
+            self.writes += 1
+
+    def evict(self):
+        # removes the oldest responses until 90% of the limit are used
+        files = sorted(self.files(), key=lambda entry: entry[2])
+        size = sum(size for (_, size, _) in files)
+        for (path, file_size, _) in files:
+            if size <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except OSError:
+                pass
+        return size
+
+    def toJson(self):
+        try:
+            with open(self.sizePath, "r") as fp:
+                self.size = read_size(fp)
+        except OSError:
+            pass
+        return {
+            "size": self.size,
+            "maxBytes": self.maxBytes,
+            "hits": self.hits,
+            "writes": self.writes
+        }
+
+
+def read_size(fp):
+    fp.seek(0)
+    try:
+        return int(fp.read())
+    except ValueError:
+        return 0
+
+
+def write_size(fp, size):
+    fp.seek(0)
+    fp.truncate()
+    fp.write(str(size))
+    fp.flush()
@@ -0,0 +1,507 @@
+import asyncio
+import copy
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import abort, g, jsonify, request
+from werkzeug.exceptions import HTTPException
+import graphsensedao as gd
+import graphsensemodel as gm
+from graphsenserest import app, start_warmup
+
+# Optional asyncio serving mode, e.g.
+#
+#     uvicorn graphsenseasync:application --port 9000
+#
+# The I/O-bound routes registered in coroutine_views run as coroutines on the
+# event loop, awaiting the driver's asynchronous requests, so a process holds
+# many of them in flight without a thread each. Their request hooks
+# (deadlines, caches, admission control, ...) run before and after the
+# coroutine in a thread pool, which also serves all other routes through the
+# Flask application. Response bodies of the latter are passed on chunk by
+# chunk, so streaming responses are not buffered.
+
+executor = ThreadPoolExecutor(app.config.get("ASYNC_WSGI_THREADS", 16))
+QUEUED_CHUNKS = 16
+coroutine_views = {}
+# coroutines of identical requests in flight, shared like single_flight
+inflight = {}
+
+
+def coroutine_view(endpoint):
+    def register(f):
+        coroutine_views[endpoint] = f
+        return f
+    return register
+
+
+def driver_future(response_future, loop):
+    # all rows of an asynchronous driver request as an asyncio future
+    future = loop.create_future()
+
+    def settle(method, value):
+        if not future.done():
+            method(value)
+
+    gd.collect_pages(
+        response_future,
+        lambda rows: loop.call_soon_threadsafe(settle, future.set_result,
+                                               rows),
+        lambda error: loop.call_soon_threadsafe(settle, future.set_exception,
+                                                error))
+    return future
+
+
+async def execute(query, currency, params, deadline):
+    # the remaining time of the request bounds the driver request as well as
+    # waiting for all of its pages
+    remaining = gd.remaining_time(deadline)
+    statement = query[currency].bind(params)
+    response_future = gd.session.execute_async(
+        statement, timeout=min(remaining, gd.query_timeout))
+    try:
+        return await asyncio.wait_for(
+            driver_future(response_future, asyncio.get_event_loop()),
+            remaining)
+    except asyncio.TimeoutError:
+        raise gd.DeadlineExceeded()
+
+
+def current_exchange_rate(currency):
+    return gm.ExchangeRate(
+        gd.all_exchange_rates[currency][gd.last_height[currency]])
+
+
+def int_arg(args, name, default):
+    value = args.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(404, "Invalid %s value" % name)
+
+
+async def query_address(currency, address, deadline):
+    if not gd.might_exist(currency, "address", address.encode("utf-8")):
+        return None
+    cached = gd.address_cache.get((currency, address))
+    if cached is not None:
+        return copy.copy(cached)
+    rows = await execute(gd.address_query, currency,
+                         [address, address[0:5]], deadline)
+    if not rows:
+        gd.record_false_positive(currency, "address")
+        return None
+    result = gm.Address(rows[0], current_exchange_rate(currency))
+    gd.address_cache.put((currency, address), result)
+    return copy.copy(result)
+
+
+async def query_cluster(currency, cluster, deadline):
+    cached = gd.cluster_cache.get((currency, int(cluster)))
+    if cached is not None:
+        return copy.copy(cached)
+    rows = await execute(gd.cluster_query, currency, [int(cluster)],
+                         deadline)
+    if not rows:
+        return None
+    result = gm.Cluster(rows[0], current_exchange_rate(currency))
+    gd.cluster_cache.put((currency, int(cluster)), result)
+    return copy.copy(result)
+
+
+async def query_tags(currency, kind, key, deadline):
+    tag_index = gd.current_tag_index(currency)
+    if kind == "address":
+        if tag_index is not None:
+            return tag_index.address_tags(key)
+        rows = await execute(gd.address_tags_query, currency, [key],
+                             deadline)
+    else:
+        if tag_index is not None:
+            return tag_index.cluster_tags(int(key))
+        rows = await execute(gd.cluster_tags_query, currency, [int(key)],
+                             deadline)
+    return [gm.Tag(row).__dict__ for row in rows]
+
+
+@coroutine_view("address")
+async def address(args, deadline, currency, address):
+    result = await query_address(currency, address, deadline)
+    return result.__dict__ if result else {}
+
+
+@coroutine_view("cluster")
+async def cluster(args, deadline, currency, cluster):
+    try:
+        cluster = int(cluster)
+    except ValueError:
+        abort(404, "Invalid cluster ID")
+    result = await query_cluster(currency, cluster, deadline)
+    return result.__dict__ if result else {}
+
+
+@coroutine_view("address_egonet")
+async def address_egonet(args, deadline, currency, address):
+    direction = args.get("direction") or ""
+    limit = int_arg(args, "limit", 50)
+    (focus_address, incoming, outgoing, tags, clusters) = \
+        await asyncio.gather(
+            query_address(currency, address, deadline),
+            execute(gd.address_incoming_relations_query, currency,
+                    [address[0:5], address, limit], deadline),
+            execute(gd.address_outgoing_relations_query, currency,
+                    [address[0:5], address, limit], deadline),
+            query_tags(currency, "address", address, deadline),
+            execute(gd.address_cluster_query, currency,
+                    [address, address[0:5]], deadline))
+    if focus_address is None:
+        abort(404, "Address %s not found" % address)
+    implicit_tags = await asyncio.gather(
+        *[query_tags(currency, "cluster", row.cluster, deadline)
+          for row in clusters])
+    exchange_rate = current_exchange_rate(currency)
+    egoNet = gm.AddressEgoNet(
+        focus_address,
+        tags,
+        [tag for cluster_tags in implicit_tags for tag in cluster_tags],
+        [gm.AddressIncomingRelations(row, exchange_rate)
+         for row in incoming],
+        [gm.AddressOutgoingRelations(row, exchange_rate)
+         for row in outgoing])
+    return egoNet.construct(address, direction)
+
+
+@coroutine_view("cluster_egonet")
+async def cluster_egonet(args, deadline, currency, cluster):
+    direction = args.get("direction") or ""
+    try:
+        cluster = str(int(cluster))
+    except ValueError:
+        abort(404, "Invalid cluster ID")
+    limit = int_arg(args, "limit", 50)
+    # relation tables are keyed by the text form of cluster IDs
+    (focus_cluster, incoming, outgoing, tags) = await asyncio.gather(
+        query_cluster(currency, cluster, deadline),
+        execute(gd.cluster_incoming_relations_query, currency,
+                [cluster, limit], deadline),
+        execute(gd.cluster_outgoing_relations_query, currency,
+                [cluster, limit], deadline),
+        query_tags(currency, "cluster", cluster, deadline))
+    if focus_cluster is None:
+        abort(404, "Cluster %s not found" % cluster)
+    exchange_rate = current_exchange_rate(currency)
+    egoNet = gm.ClusterEgoNet(
+        focus_cluster,
+        tags,
+        [gm.ClusterIncomingRelations(row, exchange_rate)
+         for row in incoming],
+        [gm.ClusterOutgoingRelations(row, exchange_rate)
+         for row in outgoing])
+    return egoNet.construct(cluster, direction)
+
+
+@coroutine_view("search")
+async def search(args, deadline, currency):
+    expression = args.get("q")
+    if not expression:
+        abort(404, "Expression parameter not provided")
+    limit = int_arg(args, "limit", 50)
+    # leading zeros are lost when converting hashes to int
+    leading_zeros = len(expression) - len(expression.lstrip("0"))
+    prefix = expression[:5]
+    (transactions, addresses) = await asyncio.gather(
+        execute(gd.transaction_search_query, currency, [prefix], deadline),
+        execute(gd.address_search_query, currency, [prefix], deadline))
+    return {
+        "addresses": [row.address for row in addresses
+                      if row.address.startswith(expression)][:limit],
+        "transactions": [tx for tx in ["0" * leading_zeros +
+                                       hex(int.from_bytes(row.tx_hash,
+                                                          byteorder="big"))[2:]
+                                       for row in transactions]
+                         if tx.startswith(expression)][:limit]
+    }
+
+
+@coroutine_view("global_search")
+async def global_search(args, deadline):
+    expression = args.get("q")
+    if not expression:
+        abort(404, "Expression parameter not provided")
+    limit = int_arg(args, "limit", 50)
+    if len(expression) < 5:
+        # prefix lookups need at least five characters
+        return {"results": [], "incomplete": []}
+    timeout = min(app.config.get("SEARCH_DEADLINE", 5),
+                  gd.remaining_time(deadline))
+    loop = asyncio.get_event_loop()
+    (requests, unavailable) = gd.global_search_requests(expression, timeout)
+    futures = {driver_future(response_future, loop): kind
+               for (response_future, kind) in requests.items()}
+    (done, pending) = await asyncio.wait(futures, timeout=timeout) \
+        if futures else (set(), set())
+    (results, incomplete) = gd.rank_global_search(
+        expression, limit, futures, done, pending, unavailable)
+    return {"results": results, "incomplete": incomplete}
+
+
+def collect_response(response, environ):
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+
+    result = response(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started[0], started[1], body
+
+
+def before_coroutine(environ):
+    # runs the before_request hooks of a coroutine view; returns the response
+    # of a hook, or the arguments and the state of the request handed on to
+    # the coroutine and to after_coroutine
+    ctx = app.request_context(environ)
+    error = None
+    try:
+        try:
+            ctx.push()
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    if g.get("trace") is not None:
+                        # traced requests are served by the Flask view
+                        rv = app.dispatch_request()
+                    else:
+                        currency = request.view_args.get("currency")
+                        if currency is not None:
+                            gd.check_currency(currency)
+                        state = g.__dict__.copy()
+                        # the request is only finished by after_coroutine,
+                        # so its teardown must not release anything yet
+                        g.__dict__.clear()
+                        return None, (request.endpoint, request.view_args,
+                                      request.args, state)
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            response = app.finalize_request(rv)
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+        return collect_response(response, environ), None
+    finally:
+        ctx.pop(error)
+
+
+def after_coroutine(environ, state, result, coroutine_error):
+    # runs the error handlers and after_request hooks of a coroutine view and
+    # finishes the request
+    ctx = app.request_context(environ)
+    error = None
+    try:
+        try:
+            ctx.push()
+            g.__dict__.update(state)
+            try:
+                if coroutine_error is not None:
+                    raise coroutine_error
+                rv = jsonify(result)
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            response = app.finalize_request(rv)
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+        return collect_response(response, environ)
+    finally:
+        ctx.pop(error)
+
+
+async def run_coroutine_view(endpoint, view_args, args, deadline):
+    # identical concurrent requests share one coroutine
+    key = (endpoint, tuple(sorted(view_args.items())),
+           tuple(sorted(args.items(multi=True))))
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(coroutine_views[endpoint](
+            args, deadline, **view_args))
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def serve_coroutine(environ, send):
+    loop = asyncio.get_event_loop()
+    (response, handed_on) = await loop.run_in_executor(
+        executor, before_coroutine, environ)
+    if response is None:
+        (endpoint, view_args, args, state) = handed_on
+        result = error = None
+        try:
+            result = await run_coroutine_view(endpoint, view_args, args,
+                                              state.get("deadline"))
+        except asyncio.CancelledError:
+            # the client is gone, the request still has to be finished
+            loop.run_in_executor(executor, after_coroutine, environ, state,
+                                 None, ClientDisconnected())
+            raise
+        except Exception as e:
+            error = e
+        response = await loop.run_in_executor(
+            executor, after_coroutine, environ, state, result, error)
+    (status, headers, body) = response
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": encode_headers(headers)
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def coroutine_endpoint(environ):
+    adapter = app.url_map.bind_to_environ(environ)
+    try:
+        (endpoint, _) = adapter.match()
+    except HTTPException:
+        return None
+    return endpoint if endpoint in coroutine_views else None
+
+
+def wsgi_environ(scope, body):
+    (server_name, server_port) = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for (name, value) in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+def encode_headers(headers):
+    return [(name.lower().encode("latin-1"), value.encode("latin-1"))
+            for (name, value) in headers]
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def serve_wsgi(environ, loop, queue, closed):
+    # runs the application in one thread per request, as request contexts
+    # are thread-local; the status and the body chunks are passed on through
+    # a bounded queue, None marks the end of the response
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def send_chunk(item):
+        if closed.is_set():
+            raise ClientDisconnected()
+        put(item)
+
+    def start_response(status, headers, exc_info=None):
+        send_chunk((int(status.split(" ", 1)[0]), headers))
+
+    try:
+        result = app(environ, start_response)
+        try:
+            for chunk in result:
+                send_chunk(chunk)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+    finally:
+        put(None)
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await asyncio.get_event_loop().run_in_executor(
+                executor, gd.connect, app)
+            start_warmup()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def drain(queue):
+    while await queue.get() is not None:
+        pass
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    loop = asyncio.get_event_loop()
+    body = await read_body(receive)
+    environ = wsgi_environ(scope, body)
+    if coroutine_endpoint(environ) is not None:
+        return await serve_coroutine(environ, send)
+    queue = asyncio.Queue(QUEUED_CHUNKS)
+    closed = threading.Event()
+    future = loop.run_in_executor(executor, serve_wsgi, environ, loop, queue,
+                                  closed)
+    response = await queue.get()
+    if response is None:
+        # the application failed before starting the response
+        await future
+        return
+    (status, headers) = response
+    finished = False
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": encode_headers(headers)
+        })
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                finished = True
+                break
+            await send({"type": "http.response.body", "body": chunk,
+                        "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    except BaseException:
+        # stops the application at its next chunk
+        closed.set()
+        if not finished:
+            asyncio.ensure_future(drain(queue))
+        raise
@@ -0,0 +1,150 @@
+import argparse
+import cassandra.cluster
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+from cassandra.query import SimpleStatement
+
+# Bloom filters of the addresses and transactions of a currency, used to
+# answer lookups of unknown addresses and transactions without querying
+# Cassandra. Filters are built offline, e.g.
+#
+#     python graphsensebloom.py btc /srv/graphsense-rest/bloom
+#
+# and memory-mapped on startup if BLOOM_FILTER_DIR is configured.
+
+MAGIC = b"GSBLOOM1"
+HEADER = struct.Struct("<8sQQQQ")  # magic, bits, hashes, items, height
+KINDS = ("address", "transaction")
+
+
+class BloomFilter(object):
+    def __init__(self, bits, hashes, items, height, data):
+        self.bits = bits
+        self.hashes = hashes
+        self.items = items
+        self.height = height
+        self.data = data
+        self.lookups = 0
+        self.definiteMisses = 0
+        self.falsePositives = 0
+
+    @classmethod
+    def create(cls, items, false_positive_rate):
+        items = max(items, 1)
+        bits = int(math.ceil(-items * math.log(false_positive_rate) /
+                             math.log(2) ** 2))
+        bits += -bits % 8
+        hashes = max(1, int(round(bits / items * math.log(2))))
+        return cls(bits, hashes, 0, 0, bytearray(bits // 8))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, bits, hashes, items, height) = HEADER.unpack_from(data)
+        if magic != MAGIC or len(data) != HEADER.size + bits // 8:
+            raise ValueError("%s is not a valid Bloom filter" % path)
+        return cls(bits, hashes, items, height,
+                   memoryview(data)[HEADER.size:])
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(HEADER.pack(MAGIC, self.bits, self.hashes, self.items,
+                                 self.height))
+            fp.write(self.data)
+        os.rename(path + ".tmp", path)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        (h1, h2) = struct.unpack("<QQ", digest)
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.data[position >> 3] |= 1 << (position & 7)
+        self.items += 1
+
+    def __contains__(self, key):
+        return all(self.data[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(key))
+
+    def might_contain(self, key):
+        self.lookups += 1
+        if key in self:
+            return True
+        self.definiteMisses += 1
+        return False
+
+    def false_positive_rate(self):
+        return (1 - math.exp(-self.hashes * self.items / self.bits)) \
+            ** self.hashes
+
+    def toJson(self):
+        passed = self.lookups - self.definiteMisses
+        return {
+            "items": self.items,
+            "bits": self.bits,
+            "hashes": self.hashes,
+            "height": self.height,
+            "estimatedFalsePositiveRate": self.false_positive_rate(),
+            "lookups": self.lookups,
+            "definiteMisses": self.definiteMisses,
+            "falsePositives": self.falsePositives,
+            "observedFalsePositiveRate":
+                self.falsePositives / passed if passed else None
+        }
+
+
+def filter_path(directory, currency, kind):
+    return os.path.join(directory, "%s_%s.bloom" % (currency, kind))
+
+
+def build(session, keyspaces, false_positive_rate, fetch_size):
+    (raw, transformed) = keyspaces
+    stats = session.execute("SELECT no_addresses, no_transactions FROM "
+                            "%s.summary_statistics LIMIT 1" % transformed)[0]
+    queries = {
+        "address": ("SELECT address, last_tx FROM %s.address" % transformed,
+                    stats.no_addresses,
+                    lambda row: (row.address.encode("utf-8"),
+                                 row.last_tx.height)),
+        "transaction": ("SELECT tx_hash, height FROM %s.transaction" % raw,
+                        stats.no_transactions,
+                        lambda row: (bytes(row.tx_hash), row.height))
+    }
+    filters = {}
+    for (kind, (query, items, key)) in queries.items():
+        bloom_filter = BloomFilter.create(items, false_positive_rate)
+        statement = SimpleStatement(query, fetch_size=fetch_size)
+        for row in session.execute(statement, timeout=None):
+            (value, height) = key(row)
+            bloom_filter.add(value)
+            # the filter covers all entries up to the highest block seen
+            bloom_filter.height = max(bloom_filter.height, height)
+        filters[kind] = bloom_filter
+    return filters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build Bloom filters of addresses and transactions")
+    parser.add_argument("currency")
+    parser.add_argument("directory")
+    parser.add_argument("--config", default="./config.json")
+    parser.add_argument("--false-positive-rate", type=float, default=0.001)
+    parser.add_argument("--fetch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as fp:
+        config = json.load(fp)
+    session = cassandra.cluster.Cluster(config["CASSANDRA_NODES"]).connect()
+    filters = build(session, config["MAPPING"][args.currency],
+                    args.false_positive_rate, args.fetch_size)
+    for (kind, bloom_filter) in filters.items():
+        bloom_filter.save(filter_path(args.directory, args.currency, kind))
+        print("Saved %s filter with %d items up to height %d" %
+              (kind, bloom_filter.items, bloom_filter.height))
@@ -0,0 +1,103 @@
+import argparse
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# request lines of nginx/Apache ("GET /btc/address/1Arch... HTTP/1.1") and
+# uWSGI (GET /btc/address/1Arch... => generated ...) access logs
+request_pattern = re.compile(r'\bGET (/[^ "]*)')
+
+
+class LRUCache(object):
+    def __init__(self, max_size, ttl):
+        self.maxSize = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.maxSize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def toJson(self):
+        return {
+            "size": len(self.entries),
+            "maxSize": self.maxSize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+def tail_lines(path, max_bytes):
+    # only the most recent part of large logs is read
+    with open(path, "rb") as fp:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(max(0, size - max_bytes))
+        if size > max_bytes:
+            fp.readline()
+        for line in fp:
+            yield line.decode("utf-8", "replace")
+
+
+def hot_paths(access_logs, hot_keys_file, n, max_bytes, accept=None):
+    # paths listed in the hot key file come first, followed by the most
+    # requested paths of the access logs
+    paths = []
+    if hot_keys_file is not None:
+        with open(hot_keys_file, "r") as fp:
+            paths = [line.strip() for line in fp
+                     if line.strip() and not line.startswith("#")]
+    counts = Counter()
+    for access_log in access_logs:
+        for line in tail_lines(access_log, max_bytes):
+            match = request_pattern.search(line)
+            if match:
+                counts[match.group(1)] += 1
+    paths += [path for (path, _) in counts.most_common()]
+    hot = []
+    seen = set()
+    for path in paths:
+        if path in seen or (accept is not None and not accept(path)):
+            continue
+        seen.add(path)
+        hot.append(path)
+        if len(hot) >= n:
+            break
+    return hot
+
+
+if __name__ == "__main__":
+    # writes a hot key file from access logs, e.g. before a deploy
+    parser = argparse.ArgumentParser(
+        description="List the most requested paths of access logs")
+    parser.add_argument("access_log", nargs="+")
+    parser.add_argument("-n", type=int, default=500)
+    parser.add_argument("--max-bytes", type=int, default=64 * 2**20)
+    args = parser.parse_args()
+
+    for path in hot_paths(args.access_log, None, args.n, args.max_bytes):
+        print(path)
@@ -1,7 +1,23 @@
 import cassandra.cluster
+import heapq
+import numpy as np
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from cassandra.cluster import EXEC_PROFILE_DEFAULT, ExecutionProfile
 from cassandra.query import named_tuple_factory, dict_factory
+import copy
+import graphsensebloom
+import graphsensecache
 import graphsensemodel as gm
-from flask import abort
+import graphsensetags
+from cassandra import OperationTimedOut
+from flask import abort, g, has_request_context
+from graphsensetrace import current_trace
 
 session = None
 tx_query = {}
@@ -31,13 +47,50 @@ cluster_outgoing_relations_without_limit_query = {}
 cluster_addresses_query = {}
 cluster_addresses_without_limit_query = {}
 block_height_query = {}
+cluster_degrees_query = {}
+address_degrees_query = {}
+all_address_tags_query = {}
+all_cluster_tags_query = {}
 statistics_query = {}
 currency_mapping = {}
+# exchange rates per height as structured arrays, exchange_rate_arrays holds
+# [eur, usd] views of the same memory
 all_exchange_rates = {}
+exchange_rate_arrays = {}
+exchange_rate_dtype = np.dtype([("eur", np.float64), ("usd", np.float64)])
+block_stats_dtype = np.dtype([("height", np.int64), ("timestamp", np.int64),
+                              ("noTransactions", np.int64),
+                              ("totalInput", np.int64),
+                              ("totalOutput", np.int64)])
+# currencies whose state was loaded by preload before uWSGI forked
+preloaded = set()
 last_height = {}
+init_status = {}
+bloom_filters = {}
+# model objects of addresses and clusters, callers get shallow copies
+address_cache = graphsensecache.LRUCache(0, 0)
+cluster_cache = graphsensecache.LRUCache(0, 0)
+# balance checkpoints of addresses and timestamps of blocks
+balance_cache = graphsensecache.LRUCache(0, 0)
+block_timestamp_cache = graphsensecache.LRUCache(100000, float("inf"))
+# per-block statistics of complete buckets of block_stats_dtype rows
+block_stats_cache = graphsensecache.LRUCache(0, 0)
+bloom_filter_dir = None
+tag_indexes = {}
+tag_index_enabled = True
+tag_index_refresh = 3600
+currency_locks = {}
+concurrency = 100
+max_block_range = 1000
+max_stats_range = 10000
+stream_fetch_size = 5000
+balance_checkpoint_rows = 5000
+aggregation_time_budget = 10
+query_timeout = 10
 
 
 def query_exchange_rates(currency, offset, limit):
+    check_currency(currency)
     if not offset:
         offset = 0
     if not limit:
@@ -50,56 +103,266 @@ def query_exchange_rates(currency, offset, limit):
 
 
 def query_block(currency, height):
-    set_keyspace(session, currency, raw=True)
+    check_currency(currency)
     if height > last_height[currency]:
         abort(404, "Block not available yet")
-    result = session.execute(block_query[currency], [height])
+    result = execute(block_query, currency, [height])
     return gm.Block(result[0]).__dict__ if result else None
 
 
 def query_statistics(currency):
-    set_keyspace(session, currency)
-    result = session.execute(statistics_query[currency])
+    check_currency(currency)
+    result = execute(statistics_query, currency)
     return gm.Statistics(result[0]).__dict__ if result else None
 
 
+def query_all_statistics():
+    # currencies with an underscore in their name are alternative keyspaces
+    currencies = [currency for currency in ready_currencies()
+                  if len(currency.split("_")) == 1]
+    futures = [as_future(session.execute_async(statistics_query[currency]))
+               for currency in currencies]
+    return {currency: gm.Statistics(future.result()[0]).__dict__
+            if future.result() else None
+            for (currency, future) in zip(currencies, futures)}
+
+
 def query_block_transactions(currency, height):
-    set_keyspace(session, currency, raw=True)
+    check_currency(currency)
     if height > last_height[currency]:
         abort(404, "Block not available yet")
-    result = session.execute(block_transactions_query[currency], [height])
+    result = execute(block_transactions_query, currency, [height])
     return gm.BlockWithTransactions(result[0], query_exchange_rate_for_height(currency, height)).__dict__ if result else None
 
 
 def query_blocks(currency, page_state):
-    set_keyspace(session, currency, raw=True)
+    check_currency(currency)
     if page_state is not None:
         page_state = bytes.fromhex(page_state)
-        results = session.execute(blocks_query[currency],
-                                  paging_state=page_state)
-    else:
-        results = session.execute(blocks_query[currency], [10])
+    results = execute(blocks_query, currency, [10], paging_state=page_state)
     page_state = results.paging_state
     blocks = [gm.Block(row).__dict__ for row in results]
     return page_state, blocks
 
 
+def query_block_range(currency, start, end, count=10):
+    check_currency(currency)
+    if end is None or end > last_height[currency]:
+        end = last_height[currency]
+    if start is None:
+        start = max(end - count + 1, 0)
+    if end - start + 1 > max_block_range:
+        abort(404, "Block range exceeds %d blocks" % max_block_range)
+    # the block table is partitioned by height, so every block is a point
+    # lookup
+    results = execute_concurrent(
+        block_query, currency,
+        [[height] for height in range(start, end + 1)])
+    return [gm.Block(rows[0]).__dict__ for (_, rows) in results if rows]
+
+
+def query_block_stats_rows(currency, heights):
+    # blocks and their transactions are point lookups of the same heights;
+    # they are fetched in batches of concurrency heights, each reduced
+    # before the next one is fetched, so only the transactions of one batch
+    # are held in memory
+    stats = np.zeros(len(heights), dtype=block_stats_dtype)
+    found = np.zeros(len(heights), dtype=bool)
+    for offset in range(0, len(heights), concurrency):
+        params = [[height] for height
+                  in heights[offset:offset + concurrency]]
+        blocks = execute_concurrent(block_query, currency, params)
+        transactions = execute_concurrent(block_transactions_query, currency,
+                                          params)
+        index, inputs, outputs = array("q"), array("q"), array("q")
+        for (i, ((_, block_rows), (_, tx_rows))) in \
+                enumerate(zip(blocks, transactions), offset):
+            if not block_rows:
+                continue
+            found[i] = True
+            stats["height"][i] = block_rows[0].height
+            stats["timestamp"][i] = block_rows[0].timestamp
+            stats["noTransactions"][i] = block_rows[0].no_transactions
+            for tx in tx_rows[0].txs if tx_rows else ():
+                index.append(i)
+                inputs.append(tx.total_input)
+                outputs.append(tx.total_output)
+        index = np.frombuffer(index, dtype=np.int64)
+        np.add.at(stats["totalInput"], index,
+                  np.frombuffer(inputs, np.int64))
+        np.add.at(stats["totalOutput"], index,
+                  np.frombuffer(outputs, np.int64))
+    return stats[found]
+
+
+def query_block_stats(currency, start, end, bucket):
+    check_currency(currency)
+    if end is None or end > last_height[currency]:
+        end = last_height[currency]
+    if start is None:
+        start = max(end - 99, 0)
+    if start > end:
+        abort(404, "Invalid block range")
+    if end - start + 1 > max_stats_range:
+        abort(404, "Block range exceeds %d blocks" % max_stats_range)
+    # buckets are aligned to multiples of the bucket size, so complete
+    # buckets can be cached and shared between overlapping ranges
+    chunks = {}
+    missing = []
+    for bucket_start in range(start - start % bucket, end + 1, bucket):
+        heights = range(max(bucket_start, start),
+                        min(bucket_start + bucket - 1, end) + 1)
+        cached = block_stats_cache.get((currency, bucket, bucket_start)) \
+            if len(heights) == bucket else None
+        if cached is None:
+            missing.extend(heights)
+        else:
+            chunks[bucket_start] = cached
+    if missing:
+        rows = query_block_stats_rows(currency, missing)
+        starts = rows["height"] - rows["height"] % bucket
+        for bucket_start in np.unique(starts):
+            chunk = rows[starts == bucket_start]
+            chunks[int(bucket_start)] = chunk
+            if bucket_start >= start and bucket_start + bucket - 1 <= end:
+                block_stats_cache.put((currency, bucket, int(bucket_start)),
+                                      chunk)
+    stats = np.concatenate([chunks[bucket_start]
+                            for bucket_start in sorted(chunks)]) \
+        if chunks else np.zeros(0, dtype=block_stats_dtype)
+
+    # per-block fiat values at the exchange rate of each block
+    rates = exchange_rates_for_heights(currency, stats["height"])
+    fiat_input = stats["totalInput"][:, np.newaxis] * rates * 1e-8
+    fiat_output = stats["totalOutput"][:, np.newaxis] * rates * 1e-8
+    buckets, index = np.unique(stats["height"] // bucket,
+                               return_inverse=True)
+
+    def bucket_sum(values):
+        sums = np.zeros(len(buckets), dtype=values.dtype)
+        np.add.at(sums, index, values)
+        return sums
+    no_blocks = np.bincount(index, minlength=len(buckets))
+    no_txs = bucket_sum(stats["noTransactions"])
+    satoshi_input = bucket_sum(stats["totalInput"])
+    satoshi_output = bucket_sum(stats["totalOutput"])
+    eur_input, usd_input = (bucket_sum(fiat_input[:, i]) for i in (0, 1))
+    eur_output, usd_output = (bucket_sum(fiat_output[:, i]) for i in (0, 1))
+    from_height = np.maximum(buckets * bucket, start)
+    to_height = np.minimum(buckets * bucket + bucket - 1, end)
+    return {
+        "fromHeight": start,
+        "toHeight": end,
+        "bucket": bucket,
+        "blocks": {
+            "height": stats["height"].tolist(),
+            "timestamp": stats["timestamp"].tolist(),
+            "noTransactions": stats["noTransactions"].tolist(),
+            "totalInput": {
+                "satoshi": stats["totalInput"].tolist(),
+                "eur": np.round(fiat_input[:, 0], 2).tolist(),
+                "usd": np.round(fiat_input[:, 1], 2).tolist()
+            },
+            "totalOutput": {
+                "satoshi": stats["totalOutput"].tolist(),
+                "eur": np.round(fiat_output[:, 0], 2).tolist(),
+                "usd": np.round(fiat_output[:, 1], 2).tolist()
+            }
+        },
+        "buckets": [gm.BlockBucket(
+            int(from_height[i]), int(to_height[i]), int(no_blocks[i]),
+            int(no_txs[i]),
+            gm.Value(int(satoshi_input[i]), round(float(eur_input[i]), 2),
+                     round(float(usd_input[i]), 2)),
+            gm.Value(int(satoshi_output[i]), round(float(eur_output[i]), 2),
+                     round(float(usd_output[i]), 2))).__dict__
+            for i in range(len(buckets))]
+    }
+
+
 def query_transaction(currency, txHash):
-    set_keyspace(session, currency, raw=True)
+    check_currency(currency)
     try:
-        rows = session.execute(tx_query[currency], [txHash[0:5], bytearray.fromhex(txHash)])
+        tx_hash = bytearray.fromhex(txHash)
     except Exception:
         abort(404, "Transaction hash is not hex")
+    if not might_exist(currency, "transaction", bytes(tx_hash)):
+        return None
+    rows = execute(tx_query, currency, [txHash[0:5], tx_hash])
+    if not rows:
+        record_false_positive(currency, "transaction")
     return gm.Transaction(rows[0], query_exchange_rate_for_height(currency, rows[0].height)).__dict__ if rows else None
 
 
+def query_transactions_by_hash(currency, tx_hashes):
+    # full transactions in the order of the given hashes, queried in one
+    # concurrent batch
+    check_currency(currency)
+    results = execute_concurrent(tx_query, currency,
+                                 [[tx_hash.hex()[0:5], tx_hash]
+                                  for tx_hash in tx_hashes])
+    return [gm.Transaction(rows[0], query_exchange_rate_for_height(
+                currency, rows[0].height)).__dict__ if rows else None
+            for (_, rows) in results]
+
+
+def resolve_addresses(currency, addresses, resolve):
+    # cluster IDs and tags of the distinct addresses, queried in one
+    # concurrent batch each
+    addresses = sorted(set(addresses))
+    resolved = {address: {} for address in addresses}
+    if "cluster" in resolve:
+        results = execute_concurrent(address_cluster_query, currency,
+                                     [[address, address[0:5]]
+                                      for address in addresses])
+        for (address, (_, rows)) in zip(addresses, results):
+            resolved[address]["cluster"] = rows[0].cluster if rows else None
+    if "tags" in resolve:
+        tag_index = current_tag_index(currency)
+        if tag_index is not None:
+            for address in addresses:
+                resolved[address]["tags"] = tag_index.address_tags(address)
+        else:
+            results = execute_concurrent(address_tags_query, currency,
+                                         [[address] for address in addresses])
+            for (address, (_, rows)) in zip(addresses, results):
+                resolved[address]["tags"] = [gm.Tag(row).__dict__
+                                             for row in rows]
+    return resolved
+
+
+def resolve_transactions(currency, transactions, resolve):
+    # adds the resolved fields to all inputs and outputs
+    participants = [participant for transaction in transactions
+                    for participant in transaction["inputs"] +
+                    transaction["outputs"]
+                    if participant["address"] is not None]
+    resolved = resolve_addresses(
+        currency, [participant["address"] for participant in participants],
+        resolve)
+    for participant in participants:
+        participant.update(resolved[participant["address"]])
+    return transactions
+
+
+def query_block_transactions_resolved(currency, height, resolve):
+    block = query_block_transactions(currency, height)
+    if block is None:
+        return None
+    transactions = query_transactions_by_hash(
+        currency, [bytes.fromhex(tx["txHash"]) for tx in block["txs"]])
+    for (tx, transaction) in zip(block["txs"], transactions):
+        tx["inputs"] = transaction["inputs"] if transaction else []
+        tx["outputs"] = transaction["outputs"] if transaction else []
+    resolve_transactions(currency, block["txs"], resolve)
+    return block
+
+
 def query_transactions(currency, page_state):
-    set_keyspace(session, currency, raw=True)
+    check_currency(currency)
     if page_state is not None:
         page_state = bytes.fromhex(page_state)
-        results = session.execute(txs_query[currency], paging_state=page_state)
-    else:
-        results = session.execute(txs_query[currency], [10])
+    results = execute(txs_query, currency, [10], paging_state=page_state)
     page_state = results.paging_state
     transactions = [gm.Transaction(row, query_exchange_rate_for_height(currency, row.height)).__dict__
                     for row in results]
@@ -107,31 +370,132 @@ def query_transactions(currency, page_state):
 
 
 def query_transaction_search(currency, expression):
-    set_keyspace(session, currency, raw=True)
-    transactions = session.execute(transaction_search_query[currency],
-                                   [expression])
+    check_currency(currency)
+    transactions = execute(transaction_search_query, currency, [expression])
     transactions._fetch_all()
     return transactions
 
 
 def query_address_search(currency, expression):
-    set_keyspace(session, currency)
-    addresses = session.execute(address_search_query[currency], [expression])
+    check_currency(currency)
+    addresses = execute(address_search_query, currency, [expression])
     addresses._fetch_all()
     return addresses
 
 
+def query_global_search(expression, limit, timeout):
+    (requests, unavailable) = global_search_requests(expression, timeout)
+    futures = {as_future(response_future): kind
+               for (response_future, kind) in requests.items()}
+    (done, pending) = wait(futures, timeout=timeout)
+    return rank_global_search(expression, limit, futures, done, pending,
+                              unavailable)
+
+
+def global_search_requests(expression, timeout):
+    # asynchronous driver requests of all ready currencies, and the
+    # currencies that are not, which are initialized in the background for
+    # later searches
+    prefix = expression[:5]
+    requests = {}
+    unavailable = []
+    for currency in currency_mapping.keys():
+        if len(currency.split("_")) != 1:
+            continue
+        if init_status.get(currency) != "ready":
+            unavailable.append(currency)
+            if init_status.get(currency) in ("deferred", "failed"):
+                init_currency_in_background(currency)
+            continue
+        requests[session.execute_async(
+            address_search_query[currency], [prefix],
+            timeout=timeout)] = (currency, "addresses")
+        requests[session.execute_async(
+            transaction_search_query[currency], [prefix],
+            timeout=timeout)] = (currency, "transactions")
+    return requests, unavailable
+
+
+def rank_global_search(expression, limit, futures, done, pending,
+                       unavailable):
+    results = {currency: {"currency": currency,
+                          "addresses": [],
+                          "transactions": []}
+               for (currency, _) in futures.values()}
+    pending = set(pending)
+    for future in done:
+        (currency, kind) = futures[future]
+        if future.exception() is not None:
+            pending.add(future)
+            continue
+        if kind == "addresses":
+            matches = [row.address for row in future.result()
+                       if row.address.startswith(expression)]
+        else:
+            matches = [tx for tx in (gm.byte_to_hex(row.tx_hash)
+                                     for row in future.result())
+                       if tx.startswith(expression)]
+        results[currency][kind] = matches[:limit]
+    incomplete = sorted({futures[future][0] for future in pending}
+                        .union(unavailable))
+    # exact matches first, then currencies with more matches; ties keep the
+    # configured currency order
+    ranked = sorted(
+        (result for result in results.values()
+         if result["addresses"] or result["transactions"]),
+        key=lambda result: (
+            expression not in result["addresses"] and
+            expression not in result["transactions"],
+            -len(result["addresses"]) - len(result["transactions"])))
+    return ranked, incomplete
+
+
+def collect_pages(response_future, handle_rows, handle_error):
+    # collects all pages of an asynchronous driver request; the handlers are
+    # called on the driver's event thread
+    rows = []
+
+    def handle_page(page):
+        rows.extend(page)
+        if response_future.has_more_pages:
+            response_future.start_fetching_next_page()
+        else:
+            handle_rows(rows)
+
+    response_future.add_callbacks(handle_page, handle_error)
+
+
+def as_future(response_future):
+    # all rows of an asynchronous driver request as a
+    # concurrent.futures.Future
+    future = Future()
+    collect_pages(response_future, future.set_result, future.set_exception)
+    return future
+
+
 def query_address(currency, address):
-    set_keyspace(session, currency)
-    rows = session.execute(address_query[currency], [address, address[0:5]])
-    return gm.Address(rows[0], gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])) if rows else None
+    check_currency(currency)
+    if not might_exist(currency, "address", address.encode("utf-8")):
+        return None
+    cached = address_cache.get((currency, address))
+    if cached is not None:
+        return copy.copy(cached)
+    rows = execute(address_query, currency, [address, address[0:5]])
+    if not rows:
+        record_false_positive(currency, "address")
+        return None
+    result = gm.Address(rows[0], gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]]))
+    address_cache.put((currency, address), result)
+    return copy.copy(result)
 
 
 def query_address_cluster(currency, address):
-    set_keyspace(session, currency)
-    clusterids = session.execute(address_cluster_query[currency],
-                                 [address, address[0:5]])
+    check_currency(currency)
     ret = {}
+    if not might_exist(currency, "address", address.encode("utf-8")):
+        return ret
+    clusterids = execute(address_cluster_query, currency,
+                         [address, address[0:5]])
     if clusterids:
         clusterid = clusterids[0].cluster
         cluster_obj = query_cluster(currency, clusterid)
@@ -140,7 +504,7 @@ def query_address_cluster(currency, address):
 
 
 def query_address_transactions(currency, page_state, address, pagesize, limit):
-    set_keyspace(session, currency)
+    check_currency(currency)
 
     if limit is None:
         query = address_transactions_without_limit_query
@@ -149,26 +513,218 @@ def query_address_transactions(currency, page_state, address, pagesize, limit):
         query = address_transactions_query
         params = [address, address[0:5], limit]
 
-    if pagesize is not None:
-        query[currency].fetch_size = pagesize
     if page_state is not None:
         page_state = bytes.fromhex(page_state)
-        rows = session.execute(query[currency], params, paging_state=page_state)
-    else:
-        rows = session.execute(query[currency], params)
+    rows = execute(query, currency, params, fetch_size=pagesize,
+                   paging_state=page_state)
     page_state = rows.paging_state
     return page_state, [row for row in rows.current_rows]
 
 
+def query_address_flows(currency, address, interval):
+    check_currency(currency)
+    values, heights, timestamps = array("q"), array("q"), array("q")
+    truncated = False
+    try:
+        for row in stream_rows(address_transactions_without_limit_query,
+                               currency, [address, address[0:5]],
+                               deadline=aggregation_deadline()):
+            values.append(row.value)
+            heights.append(row.height)
+            timestamps.append(row.timestamp)
+    except (DeadlineExceeded, OperationTimedOut):
+        truncated = True
+    if not values:
+        return [], truncated
+    values = np.frombuffer(values, dtype=np.int64)
+    heights = np.frombuffer(heights, dtype=np.int64)
+    buckets, index = np.unique(time_buckets(
+        np.frombuffer(timestamps, dtype=np.int64), interval),
+        return_inverse=True)
+    # value every transaction at the exchange rate of its block
+    rates = exchange_rates_for_heights(currency, heights)
+    fiat = values[:, np.newaxis] * rates * 1e-8
+    incoming = values > 0
+    outgoing = values < 0
+
+    def bucket_sum(weights, mask):
+        return np.bincount(index[mask], weights=weights[mask],
+                           minlength=len(buckets))
+    no_txs = np.bincount(index, minlength=len(buckets))
+    satoshi_in = np.zeros(len(buckets), dtype=np.int64)
+    np.add.at(satoshi_in, index[incoming], values[incoming])
+    satoshi_out = np.zeros(len(buckets), dtype=np.int64)
+    np.add.at(satoshi_out, index[outgoing], -values[outgoing])
+    eur_in, usd_in = (bucket_sum(fiat[:, i], incoming) for i in (0, 1))
+    eur_out, usd_out = (-bucket_sum(fiat[:, i], outgoing) for i in (0, 1))
+    min_height = np.full(len(buckets), np.iinfo(np.int64).max)
+    np.minimum.at(min_height, index, heights)
+    max_height = np.zeros(len(buckets), dtype=np.int64)
+    np.maximum.at(max_height, index, heights)
+    starts = buckets.astype("datetime64[s]").astype(np.int64)
+    flows = [gm.AddressFlow(int(starts[i]), int(min_height[i]),
+                            int(max_height[i]), int(no_txs[i]),
+                            gm.Value(int(satoshi_in[i]), float(eur_in[i]),
+                                     float(usd_in[i])),
+                            gm.Value(int(satoshi_out[i]), float(eur_out[i]),
+                                     float(usd_out[i]))).__dict__
+             for i in range(len(buckets))]
+    return flows, truncated
+
+
+def balance_scan(currency, address):
+    # sparse checkpoints of the scan of the transactions of an address: the
+    # paging state after each page of balance_checkpoint_rows rows and the
+    # last height, cumulative balance and number of transactions up to it;
+    # partial scans are cached as well and resumed by later requests
+    scan = balance_cache.get((currency, address))
+    if scan is None:
+        scan = {
+            "lock": threading.Lock(),
+            "heights": array("q", [-1]),
+            "balances": array("q", [0]),
+            "counts": array("q", [0]),
+            "pagingStates": [None],
+            "complete": False
+        }
+        balance_cache.put((currency, address), scan)
+    return scan
+
+
+def scan_balance(currency, address, scan, height):
+    # the transactions of an address are clustered by ascending height, so
+    # the scan starts at the last checkpoint at or below the height and stops
+    # at the first row above it; pages after the last checkpoint add new ones
+    k = bisect_right(scan["heights"], height) - 1
+    balance = scan["balances"][k]
+    count = scan["counts"][k]
+    extending = k == len(scan["heights"]) - 1
+    if extending and scan["complete"]:
+        return balance, count, False
+    paging_state = scan["pagingStates"][k]
+    deadline = aggregation_deadline()
+    try:
+        while True:
+            rows = execute(address_transactions_without_limit_query,
+                           currency, [address, address[0:5]],
+                           fetch_size=balance_checkpoint_rows,
+                           deadline=deadline, paging_state=paging_state)
+            page = rows.current_rows
+            for row in page:
+                if row.height > height:
+                    return balance, count, False
+                balance += row.value
+                count += 1
+            paging_state = rows.paging_state
+            if extending and page:
+                scan["heights"].append(page[-1].height)
+                scan["balances"].append(balance)
+                scan["counts"].append(count)
+                scan["pagingStates"].append(paging_state)
+            if paging_state is None:
+                if extending:
+                    scan["complete"] = True
+                return balance, count, False
+    except (DeadlineExceeded, OperationTimedOut):
+        return balance, count, True
+
+
+def query_address_balance(currency, address, height):
+    check_currency(currency)
+    if height is None:
+        height = last_height[currency]
+    if height < 0 or height > last_height[currency]:
+        abort(404, "Block not available yet")
+    scan = balance_scan(currency, address)
+    with scan["lock"]:
+        (balance, count, truncated) = scan_balance(currency, address, scan,
+                                                   height)
+    rate = gm.ExchangeRate(all_exchange_rates[currency][height])
+    return {
+        "address": address,
+        "height": height,
+        "balance": gm.Value(balance, balance * rate.eur * 1e-8,
+                            balance * rate.usd * 1e-8).__dict__,
+        "noTransactions": count,
+        "truncated": truncated
+    }
+
+
+def block_timestamp(currency, height):
+    timestamp = block_timestamp_cache.get((currency, height))
+    if timestamp is None:
+        rows = execute(block_query, currency, [height])
+        if not rows:
+            return None
+        timestamp = rows[0].timestamp
+        block_timestamp_cache.put((currency, height), timestamp)
+    return timestamp
+
+
+def query_height_for_timestamp(currency, timestamp):
+    # binary search for the last block with a timestamp not after the given
+    # one; block timestamps are only roughly monotonic, so the result can be
+    # off by a few blocks around the timestamp
+    check_currency(currency)
+
+    def existing_block_timestamp(height):
+        result = block_timestamp(currency, height)
+        if result is None:
+            abort(404, "Block %d not found" % height)
+        return result
+    if existing_block_timestamp(0) > timestamp:
+        return None
+    (low, high) = (0, last_height[currency])
+    while low < high:
+        middle = (low + high + 1) // 2
+        if existing_block_timestamp(middle) <= timestamp:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def time_buckets(timestamps, interval):
+    days = timestamps // 86400
+    if interval == "day":
+        return days.astype("datetime64[D]")
+    if interval == "week":
+        # the epoch is a Thursday; weeks start on Monday
+        return (days - (days + 3) % 7).astype("datetime64[D]")
+    return timestamps.astype("datetime64[s]").astype("datetime64[M]")
+
+
+def exchange_rates_for_heights(currency, heights):
+    # rows of [eur, usd]; blocks above the last height use the latest rate
+    return exchange_rate_arrays[currency][
+        np.minimum(heights, last_height[currency])]
+
+
 def query_address_tags(currency, address):
-    set_keyspace(session, currency)
-    tags = session.execute(address_tags_query[currency], [address])
+    check_currency(currency)
+    tag_index = current_tag_index(currency)
+    if tag_index is not None:
+        return tag_index.address_tags(address)
+    tags = execute(address_tags_query, currency, [address])
     return [gm.Tag(row).__dict__ for row in tags]
 
 
+def query_tag_search(currency, expression, fields, offset, limit):
+    check_currency(currency)
+    tag_index = current_tag_index(currency)
+    if tag_index is None:
+        abort(503, "Tag index is disabled")
+    (total, entities) = tag_index.search(expression, fields, offset, limit)
+    results = [{"address": key, "tags": tag_index.address_tags(key)}
+               if kind == "address" else
+               {"cluster": key, "tags": tag_index.cluster_tags(key)}
+               for (kind, key) in entities]
+    return total, results
+
+
 def query_implicit_tags(currency, address):
-    set_keyspace(session, currency)
-    clusters = session.execute(address_cluster_query[currency], [address, address[0:5]])
+    check_currency(currency)
+    clusters = execute(address_cluster_query, currency, [address, address[0:5]])
     implicit_tags = []
     for (clusterrow) in clusters:
         clustertags = query_cluster_tags(currency, clusterrow.cluster)
@@ -178,20 +734,17 @@ def query_implicit_tags(currency, address):
 
 
 def query_address_incoming_relations(currency, page_state, address, pagesize, limit):
-    set_keyspace(session, currency)
+    check_currency(currency)
     if limit is None:
         query = address_incoming_relations_without_limit_query
         params = [address[0:5], address]
     else:
         query = address_incoming_relations_query
         params = [address[0:5], address, limit]
-    if pagesize is not None:
-        query[currency].fetch_size = pagesize
     if page_state is not None:
         page_state = bytes.fromhex(page_state)
-        rows = session.execute(query[currency], params, paging_state=page_state)
-    else:
-        rows = session.execute(query[currency], params)
+    rows = execute(query, currency, params, fetch_size=pagesize,
+                   paging_state=page_state)
     page_state = rows.paging_state
     exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
     relations = [gm.AddressIncomingRelations(row, exchange_rate)
@@ -200,20 +753,17 @@ def query_address_incoming_relations(currency, page_state, address, pagesize, li
 
 
 def query_address_outgoing_relations(currency, page_state, address, pagesize, limit):
-    set_keyspace(session, currency)
+    check_currency(currency)
     if limit is None:
         query = address_outgoing_relations_without_limit_query
         params = [address[0:5], address]
     else:
         query = address_outgoing_relations_query
         params = [address[0:5], address, limit]
-    if pagesize is not None:
-        query[currency].fetch_size = pagesize
     if page_state is not None:
         page_state = bytes.fromhex(page_state)
-        rows = session.execute(query[currency], params, paging_state=page_state)
-    else:
-        rows = session.execute(query[currency], params)
+    rows = execute(query, currency, params, fetch_size=pagesize,
+                   paging_state=page_state)
     page_state = rows.paging_state
     exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
     relations = [gm.AddressOutgoingRelations(row, exchange_rate)
@@ -222,21 +772,31 @@ def query_address_outgoing_relations(currency, page_state, address, pagesize, li
 
 
 def query_cluster(currency, cluster):
-    set_keyspace(session, currency)
-    rows = session.execute(cluster_query[currency], [int(cluster)])
-    return gm.Cluster(rows.current_rows[0],
-                      gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])) if rows else None
+    check_currency(currency)
+    cached = cluster_cache.get((currency, int(cluster)))
+    if cached is not None:
+        return copy.copy(cached)
+    rows = execute(cluster_query, currency, [int(cluster)])
+    if not rows:
+        return None
+    result = gm.Cluster(rows.current_rows[0],
+                        gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]]))
+    cluster_cache.put((currency, int(cluster)), result)
+    return copy.copy(result)
 
 
 def query_cluster_tags(currency, cluster):
-    set_keyspace(session, currency)
-    tags = session.execute(cluster_tags_query[currency], [int(cluster)])
+    check_currency(currency)
+    tag_index = current_tag_index(currency)
+    if tag_index is not None:
+        return tag_index.cluster_tags(int(cluster))
+    tags = execute(cluster_tags_query, currency, [int(cluster)])
     clustertags = [gm.Tag(tagrow).__dict__ for (tagrow) in tags]
     return clustertags
 
 
 def query_cluster_addresses(currency, cluster, page, pagesize, limit):
-    set_keyspace(session, currency)
+    check_currency(currency)
     if limit is None:
         query = cluster_addresses_without_limit_query
         params = [int(cluster)]
@@ -244,34 +804,226 @@ def query_cluster_addresses(currency, cluster, page, pagesize, limit):
         query = cluster_addresses_query
         params = [int(cluster), limit]
 
-    if pagesize is not None:
-        query[currency].fetch_size = pagesize
     if page is not None:
         page = bytes.fromhex(page)
-        rows = session.execute(query[currency], params, paging_state=page)
-    else:
-        rows = session.execute(query[currency], params)
-    clusteraddresses = [gm.ClusterAddresses(row, gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])).__dict__
+    rows = execute(query, currency, params, fetch_size=pagesize,
+                   paging_state=page)
+    exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
+    clusteraddresses = [gm.ClusterAddresses(row, exchange_rate).__dict__
                         for row in rows.current_rows]
     page = rows.paging_state
     return page, clusteraddresses
 
 
+cluster_address_keys = {
+    "balance": lambda row: (row.total_received.satoshi -
+                            row.total_spent.satoshi),
+    "received": lambda row: row.total_received.satoshi,
+    "degree": lambda row: row.in_degree + row.out_degree
+}
+
+
+def query_cluster_addresses_top(currency, cluster, n, order):
+    check_currency(currency)
+    key = cluster_address_keys[order]
+    # bounded min-heap of (key, sequence number, row); the sequence number
+    # avoids comparing rows on ties
+    top = []
+    histograms = {name: Counter() for name in cluster_address_keys}
+    summary = {"noAddresses": 0, "balance": 0, "received": 0}
+    truncated = False
+    try:
+        for (i, row) in enumerate(stream_rows(
+                cluster_addresses_without_limit_query, currency,
+                [int(cluster)], deadline=aggregation_deadline())):
+            for (name, fn) in cluster_address_keys.items():
+                histograms[name][log_bucket(fn(row))] += 1
+            summary["noAddresses"] += 1
+            summary["balance"] += cluster_address_keys["balance"](row)
+            summary["received"] += row.total_received.satoshi
+            if len(top) < n:
+                heapq.heappush(top, (key(row), i, row))
+            elif key(row) > top[0][0]:
+                heapq.heapreplace(top, (key(row), i, row))
+    except (DeadlineExceeded, OperationTimedOut):
+        truncated = True
+    exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
+    addresses = [gm.ClusterAddresses(row, exchange_rate).__dict__
+                 for (_, _, row) in sorted(top, reverse=True)]
+    summary["histograms"] = {
+        name: [{"from": 10**(bucket - 1) if bucket else 0,
+                "to": 10**bucket,
+                "count": counts[bucket]}
+               for bucket in sorted(counts)]
+        for (name, counts) in histograms.items()}
+    return addresses, summary, truncated
+
+
+# (relations query, model, value, neighbor) of the neighbors of an address
+# or cluster in each direction
+neighbor_relations = {
+    ("address", "in"): (address_incoming_relations_without_limit_query,
+                        gm.AddressIncomingRelations,
+                        lambda row: row.estimated_value.satoshi,
+                        lambda row: row.src_address),
+    ("address", "out"): (address_outgoing_relations_without_limit_query,
+                         gm.AddressOutgoingRelations,
+                         lambda row: row.estimated_value.satoshi,
+                         lambda row: row.dst_address),
+    ("cluster", "in"): (cluster_incoming_relations_without_limit_query,
+                        gm.ClusterIncomingRelations,
+                        lambda row: row.value.satoshi,
+                        lambda row: row.src_cluster),
+    ("cluster", "out"): (cluster_outgoing_relations_without_limit_query,
+                         gm.ClusterOutgoingRelations,
+                         lambda row: row.value.satoshi,
+                         lambda row: row.dst_cluster)
+}
+neighbor_orders = ("value", "transactions")
+# relations queries with a limit per partition, used by walk_relations
+limited_relations = {
+    ("address", "in"): address_incoming_relations_query,
+    ("address", "out"): address_outgoing_relations_query,
+    ("cluster", "in"): cluster_incoming_relations_query,
+    ("cluster", "out"): cluster_outgoing_relations_query
+}
+
+
+def query_neighbors_top(currency, kind, node, direction, n, order,
+                        min_value, min_transactions, tagged):
+    check_currency(currency)
+    (query, model, value, neighbor) = neighbor_relations[(kind, direction)]
+    # relation tables are keyed by the text form of cluster IDs
+    params = [node[0:5], node] if kind == "address" else [str(node)]
+    key = value if order == "value" else (lambda row: row.no_transactions)
+    tag_index = None
+    if tagged:
+        tag_index = current_tag_index(currency)
+        if tag_index is None:
+            abort(503, "Tag index is disabled")
+    # bounded min-heap as in query_cluster_addresses_top
+    top = []
+    truncated = False
+    try:
+        for (i, row) in enumerate(stream_rows(
+                query, currency, params, deadline=aggregation_deadline())):
+            if value(row) < min_value or \
+                    row.no_transactions < min_transactions:
+                continue
+            if tag_index is not None and \
+                    not tagged_node(tag_index, kind, neighbor(row)):
+                continue
+            if len(top) < n:
+                heapq.heappush(top, (key(row), i, row))
+            elif key(row) > top[0][0]:
+                heapq.heapreplace(top, (key(row), i, row))
+    except (DeadlineExceeded, OperationTimedOut):
+        truncated = True
+    exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
+    neighbors = [model(row, exchange_rate)
+                 for (_, _, row) in sorted(top, reverse=True)]
+    return neighbors, truncated
+
+
+def tagged_node(tag_index, kind, node):
+    # the tag index keys clusters by integer, cluster relations hold their
+    # neighbors as text, which may also be addresses
+    if kind == "cluster" and str(node).isdigit():
+        return tag_index.tagged("cluster", int(node))
+    return tag_index.tagged("address", node)
+
+
+def relations_future(currency, kind, node, direction, limit):
+    query = limited_relations[(kind, direction)]
+    params = [node[0:5], node, limit] if kind == "address" \
+        else [node, limit]
+    statement = query[currency].bind(params)
+    statement.fetch_size = stream_fetch_size
+    return as_future(session.execute_async(
+        statement, timeout=min(remaining_time() or query_timeout,
+                               query_timeout)))
+
+
+def walk_relations(currency, kind, seeds, depth, directions, limit,
+                   max_nodes, state):
+    # breadth-first walk from the seed nodes yielding relation models; the
+    # relations of up to `concurrency` nodes of a level are queried at once.
+    # At most max_nodes nodes are expanded, state["truncated"] is set if
+    # further nodes were skipped
+    check_currency(currency)
+    exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
+    visited = set(seeds)
+    frontier = list(seeds)
+    for level in range(depth):
+        next_frontier = []
+        for start in range(0, len(frontier), concurrency):
+            futures = {relations_future(currency, kind, node, direction,
+                                        limit): direction
+                       for node in frontier[start:start + concurrency]
+                       for direction in directions}
+            for future in as_completed(futures):
+                (_, model, _, neighbor) = \
+                    neighbor_relations[(kind, futures[future])]
+                for row in future.result():
+                    yield model(row, exchange_rate)
+                    # nodes of the last level are not expanded
+                    if level == depth - 1 or neighbor(row) in visited:
+                        continue
+                    if len(visited) >= max_nodes:
+                        state["truncated"] = True
+                        continue
+                    visited.add(neighbor(row))
+                    next_frontier.append(neighbor(row))
+        frontier = next_frontier
+
+
+def log_bucket(value):
+    # number of decimal digits, i.e. [10^(b-1), 10^b); 0 for values below 1
+    return len(str(value)) if value > 0 else 0
+
+
+def stream_rows(query, currency, params, fetch_size=None, deadline=None):
+    rows = execute(query, currency, params,
+                   fetch_size=fetch_size or stream_fetch_size,
+                   deadline=deadline)
+    trace = current_trace()
+    entry = trace.queries[-1] if trace is not None else None
+    while True:
+        for row in rows.current_rows:
+            yield row
+        if not rows.has_more_pages:
+            break
+        remaining_time(deadline)
+        start = time.time()
+        rows.fetch_next_page()
+        if entry is not None:
+            trace.record_page(entry, rows, time.time() - start)
+
+
+def query_top_degree(currency, kind, n):
+    # full table scan, only used by offline jobs
+    check_currency(currency)
+    if kind == "cluster":
+        rows = stream_rows(cluster_degrees_query, currency, [])
+    else:
+        rows = stream_rows(address_degrees_query, currency, [])
+    top = heapq.nlargest(n, rows,
+                         key=lambda row: row.in_degree + row.out_degree)
+    return [row[0] for row in top]
+
+
 def query_cluster_incoming_relations(currency, page_state, cluster, pagesize, limit):
-    set_keyspace(session, currency)
+    check_currency(currency)
     if limit is None:
         query = cluster_incoming_relations_without_limit_query
         params = [cluster]
     else:
         query = cluster_incoming_relations_query
         params = [cluster, limit]
-    if pagesize is not None:
-        query[currency].fetch_size = pagesize
     if page_state is not None:
         page_state = bytes.fromhex(page_state)
-        rows = session.execute(query[currency], params, paging_state=page_state)
-    else:
-        rows = session.execute(query[currency], params)
+    rows = execute(query, currency, params, fetch_size=pagesize,
+                   paging_state=page_state)
     page_state = rows.paging_state
     exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
     relations = [gm.ClusterIncomingRelations(row, exchange_rate) for row in rows.current_rows]
@@ -279,61 +1031,130 @@ def query_cluster_incoming_relations(currency, page_state, cluster, pagesize, li
 
 
 def query_cluster_outgoing_relations(currency, page_state, cluster, pagesize, limit):
-    set_keyspace(session, currency)
+    check_currency(currency)
     if limit is None:
         query = cluster_outgoing_relations_without_limit_query
         params = [cluster]
     else:
         query = cluster_outgoing_relations_query
         params = [cluster, limit]
-    if pagesize is not None:
-        query[currency].fetch_size = pagesize
     if page_state is not None:
         page_state = bytes.fromhex(page_state)
-        rows = session.execute(query[currency], params, paging_state=page_state)
-    else:
-        rows = session.execute(query[currency], params)
+    rows = execute(query, currency, params, fetch_size=pagesize,
+                   paging_state=page_state)
     page_state = rows.paging_state
     exchange_rate = gm.ExchangeRate(all_exchange_rates[currency][last_height[currency]])
     relations = [gm.ClusterOutgoingRelations(row, exchange_rate) for row in rows.current_rows]
     return page_state, relations
 
 
-def set_keyspace(session, currency, raw=False):
-    if currency in currency_mapping:
-        if raw:
-            session.set_keyspace(currency_mapping[currency][0])
-        else:
-            session.set_keyspace(currency_mapping[currency][1])
-    else:
+def execute(query, currency, params=None, fetch_size=None, deadline=None,
+            **kwargs):
+    # bind a new statement per request instead of changing the shared
+    # prepared statement, so concurrent requests do not interfere
+    statement = query[currency].bind(params or [])
+    if fetch_size is not None:
+        statement.fetch_size = fetch_size
+    remaining = remaining_time(deadline)
+    if remaining is not None and "timeout" not in kwargs:
+        kwargs["timeout"] = min(remaining, query_timeout)
+    trace = current_trace()
+    if trace is None:
+        return session.execute(statement, **kwargs)
+    start = time.time()
+    rows = session.execute(statement, trace=trace.cassandraTracing, **kwargs)
+    trace.record(statement, rows, time.time() - start)
+    return rows
+
+
+def execute_concurrent(query, currency, params):
+    # results are returned in the order of the parameters; at most
+    # concurrency statements are in flight, each limited to the remaining
+    # time of the request, and none are submitted once it has run out
+    start = time.time()
+    slots = threading.Semaphore(concurrency)
+    futures = []
+    for values in params:
+        remaining = remaining_time()
+        if not slots.acquire(timeout=remaining):
+            raise DeadlineExceeded()
+        statement = query[currency].bind(values)
+        try:
+            future = as_future(session.execute_async(
+                statement, timeout=min(remaining or query_timeout,
+                                       query_timeout)))
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda future: slots.release())
+        futures.append(future)
+    (_, pending) = wait(futures, timeout=remaining_time())
+    if pending:
+        raise DeadlineExceeded()
+    results = [(True, future.result()) for future in futures]
+    trace = current_trace()
+    if trace is not None:
+        trace.record_batch(query[currency], params, results,
+                           time.time() - start)
+    return results
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def remaining_time(deadline=None):
+    # seconds left until the earlier of the given and the request deadline
+    deadlines = [deadline]
+    if has_request_context():
+        deadlines.append(g.get("deadline"))
+    deadlines = [d for d in deadlines if d is not None]
+    if not deadlines:
+        return None
+    remaining = min(deadlines) - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return remaining
+
+
+def aggregation_deadline():
+    return time.time() + aggregation_time_budget
+
+
+def check_currency(currency):
+    if currency not in currency_mapping:
         abort(404, "Currency %s does not exist" % currency)
+    if init_status[currency] != "ready":
+        try:
+            init_currency(currency)
+        except BaseException:
+            abort(503, "Currency %s is not available" % currency)
 
 
 def query_all_exchange_rates(currency, h_max):
+    # loaders run from init_currency and must not call check_currency,
+    # which would wait for the initialization lock held by this thread
     try:
-        set_keyspace(session, currency, raw=True)
-        session.row_factory = dict_factory
-        session.default_fetch_size = None
         print("Loading exchange rates for %s ..." % currency)
-        results = session.execute(exchange_rates_query[currency], [h_max],
-                                  timeout=180)
-        d = {row["height"]: {"eur": row["eur"], "usd": row["usd"]}
-             for row in results}
+        results = execute(exchange_rates_query, currency, [h_max],
+                          fetch_size=stream_fetch_size, timeout=180,
+                          execution_profile="dict")
+        rates = np.zeros(h_max + 1, dtype=exchange_rate_dtype)
+        for row in results:
+            if row["height"] <= h_max:
+                rates[row["height"]] = (row["eur"], row["usd"])
         print("Rates loaded.")
-        session.row_factory = named_tuple_factory  # reset default
-        return d
+        return rates
     except Exception as e:
-        session.row_factory = named_tuple_factory
         print("Failed to query exchange rates. Cause: \n%s" % str(e))
         raise SystemExit
 
 
 def query_last_block_height(currency):
-    set_keyspace(session, currency, raw=True)
     block_max = 0
     block_inc = 100000
     while True:
-        rs = session.execute(block_height_query[currency], [block_max])
+        rs = execute(block_height_query, currency, [block_max])
         if not rs:
             if block_max == 0:
                 return 0
@@ -355,65 +1176,229 @@ def query_exchange_rate_for_height(currency, height):
 
 
 def connect(app):
-    global address_cluster_query, address_incoming_relations_query, \
-           address_outgoing_relations_query, address_query, \
-           address_search_query, address_tags_query, \
-           address_transactions_query, all_exchange_rates, \
-           block_height_query, block_query, block_transactions_query, \
-           blocks_query, cluster_addresses_query, \
-           cluster_incoming_relations_query, \
-           cluster_outgoing_relations_query, \
-           cluster_query, cluster_tags_query, currency_mapping, \
-           exchange_rate_for_height_query, exchange_rates_query, \
-           last_height, session, statistics_query, transaction_search_query, \
-           tx_query, txs_query
-
-    cluster = cassandra.cluster.Cluster(app.config["CASSANDRA_NODES"])
+    create_session(app)
+
+    # rarely used currencies can be deferred until their first request
+    deferred = app.config.get("DEFERRED_CURRENCIES", [])
+    for currency in currency_mapping.keys():
+        currency_locks[currency] = threading.Lock()
+        init_status[currency] = "deferred" if currency in deferred \
+            else "pending"
+    currencies = [currency for currency in currency_mapping.keys()
+                  if currency not in deferred]
+    if currencies:
+        with ThreadPoolExecutor(len(currencies)) as executor:
+            list(executor.map(init_currency, currencies))
+    app.logger.debug("Created prepared statements")
+
+
+def create_session(app):
+    global address_cache, aggregation_time_budget, balance_cache, \
+           balance_checkpoint_rows, block_stats_cache, bloom_filter_dir, \
+           cluster_cache, concurrency, currency_mapping, max_block_range, \
+           max_stats_range, query_timeout, session, stream_fetch_size, \
+           tag_index_enabled, tag_index_refresh
+
+    query_timeout = app.config.get("CASSANDRA_TIMEOUT", query_timeout)
+    # row factories are selected per request through execution profiles
+    # instead of changing the shared session
+    cluster = cassandra.cluster.Cluster(
+        app.config["CASSANDRA_NODES"],
+        execution_profiles={
+            EXEC_PROFILE_DEFAULT: ExecutionProfile(
+                row_factory=named_tuple_factory,
+                request_timeout=query_timeout),
+            "dict": ExecutionProfile(row_factory=dict_factory)
+        })
     app.logger.debug("Created new Cassandra cluster.")
 
-    # set the first keyspace in mapping to the default in order to be able to
-    # create the prepared statements; alternative strategy is to not use
-    # prepared statements and specify the keyspace in the query string
+    # statements name their keyspace explicitly, so the session does not
+    # need a default keyspace
     currency_mapping = app.config["MAPPING"]
-    currency = list(currency_mapping.keys())[0]  # just to get the session
-    session = cluster.connect(currency_mapping[currency][1])
+    session = cluster.connect()
     session.default_fetch_size = 10
+    concurrency = app.config.get("CASSANDRA_CONCURRENCY", concurrency)
+    max_block_range = app.config.get("MAX_BLOCK_RANGE", max_block_range)
+    max_stats_range = app.config.get("MAX_STATS_RANGE", max_stats_range)
+    stream_fetch_size = app.config.get("STREAM_FETCH_SIZE", stream_fetch_size)
+    balance_checkpoint_rows = app.config.get("BALANCE_CHECKPOINT_ROWS",
+                                             balance_checkpoint_rows)
+    aggregation_time_budget = app.config.get("AGGREGATION_TIME_BUDGET",
+                                             aggregation_time_budget)
+    bloom_filter_dir = app.config.get("BLOOM_FILTER_DIR")
+    tag_index_enabled = app.config.get("TAG_INDEX", tag_index_enabled)
+    tag_index_refresh = app.config.get("TAG_INDEX_REFRESH", tag_index_refresh)
+    address_cache = graphsensecache.LRUCache(
+        app.config.get("ENTITY_CACHE_SIZE", 100000),
+        app.config.get("CACHE_TTL", 600))
+    cluster_cache = graphsensecache.LRUCache(
+        app.config.get("ENTITY_CACHE_SIZE", 100000),
+        app.config.get("CACHE_TTL", 600))
+    balance_cache = graphsensecache.LRUCache(
+        app.config.get("BALANCE_CACHE_SIZE", 1000),
+        app.config.get("CACHE_TTL", 600))
+    block_stats_cache = graphsensecache.LRUCache(
+        app.config.get("BLOCK_STATS_CACHE_SIZE", 10000),
+        app.config.get("CACHE_TTL", 600))
     app.logger.debug("Created new Cassandra session.")
-    for currency in currency_mapping.keys():
-        set_keyspace(session, currency)
-        address_query[currency] = session.prepare("SELECT * FROM address WHERE address = ? AND address_prefix = ?")
-        address_search_query[currency] = session.prepare("SELECT address FROM address WHERE address_prefix = ?")
-        address_transactions_query[currency] = session.prepare("SELECT * FROM address_transactions WHERE address = ? AND address_prefix = ? LIMIT ?")
-        address_transactions_without_limit_query[currency] = session.prepare("SELECT * FROM address_transactions WHERE address = ? AND address_prefix = ?")
-        address_tags_query[currency] = session.prepare("SELECT * FROM address_tags WHERE address = ?")
-        address_cluster_query[currency] = session.prepare("SELECT cluster FROM address_cluster WHERE address = ? AND address_prefix = ?")
-        address_incoming_relations_query[currency] = session.prepare("SELECT * FROM address_incoming_relations WHERE dst_address_prefix = ? AND dst_address = ? LIMIT ?")
-        address_incoming_relations_without_limit_query[currency] = session.prepare("SELECT * FROM address_incoming_relations WHERE dst_address_prefix = ? AND dst_address = ?")
-        address_outgoing_relations_query[currency] = session.prepare("SELECT * FROM address_outgoing_relations WHERE src_address_prefix = ? AND src_address = ? LIMIT ?")
-        address_outgoing_relations_without_limit_query[currency] = session.prepare("SELECT * FROM address_outgoing_relations WHERE src_address_prefix = ? AND src_address = ?")
-        cluster_incoming_relations_query[currency] = session.prepare("SELECT * FROM cluster_incoming_relations WHERE dst_cluster = ? LIMIT ?")
-        cluster_incoming_relations_without_limit_query[currency] = session.prepare("SELECT * FROM cluster_incoming_relations WHERE dst_cluster = ?")
-        cluster_outgoing_relations_query[currency] = session.prepare("SELECT * FROM cluster_outgoing_relations WHERE src_cluster = ? LIMIT ?")
-        cluster_outgoing_relations_without_limit_query[currency] = session.prepare("SELECT * FROM cluster_outgoing_relations WHERE src_cluster = ?")
-        cluster_tags_query[currency] = session.prepare("SELECT * FROM cluster_tags WHERE cluster = ?")
-        cluster_query[currency] = session.prepare("SELECT * FROM cluster WHERE cluster = ?")
-        cluster_addresses_query[currency] = session.prepare("SELECT * FROM cluster_addresses WHERE cluster = ? LIMIT ?")
-        cluster_addresses_without_limit_query[currency] = session.prepare("SELECT * FROM cluster_addresses WHERE cluster = ?")
-        statistics_query[currency] = session.prepare("SELECT * FROM summary_statistics LIMIT 1")
-
-        set_keyspace(session, currency, raw=True)
-        tx_query[currency] = session.prepare("SELECT * FROM transaction WHERE tx_prefix = ? AND tx_hash = ?")
-        txs_query[currency] = session.prepare("SELECT * FROM transaction LIMIT ?")
-        transaction_search_query[currency] = session.prepare("SELECT tx_hash from transaction where tx_prefix = ?")
-        block_transactions_query[currency] = session.prepare("SELECT * FROM block_transactions WHERE height = ?")
-        block_query[currency] = session.prepare("SELECT * FROM block WHERE height = ?")
-        blocks_query[currency] = session.prepare("SELECT * FROM block LIMIT ?")
-        exchange_rates_query[currency] = session.prepare("SELECT * FROM exchange_rates LIMIT ?")
-        exchange_rate_for_height_query[currency] = session.prepare("SELECT * FROM exchange_rates WHERE height = ?")
-        block_height_query[currency] = session.prepare("SELECT height FROM exchange_rates WHERE height = ?")
-
-        last_height[currency] = query_last_block_height(currency)
-        all_exchange_rates[currency] = query_all_exchange_rates(currency,
-                                                                last_height[currency])
 
-    app.logger.debug("Created prepared statements")
+
+def init_currency(currency):
+    with currency_locks[currency]:
+        if init_status[currency] == "ready":
+            return
+        init_status[currency] = "loading"
+        try:
+            prepare_statements(currency)
+            if currency not in preloaded:
+                load_state(currency)
+        except BaseException:
+            init_status[currency] = "failed"
+            raise
+        init_status[currency] = "ready"
+
+
+def init_currency_in_background(currency):
+    # a failure leaves the currency failed, so later requests retry
+    def init():
+        try:
+            init_currency(currency)
+        except BaseException:
+            pass
+    threading.Thread(target=init, daemon=True).start()
+
+
+def load_state(currency):
+    last_height[currency] = query_last_block_height(currency)
+    all_exchange_rates[currency] = query_all_exchange_rates(
+        currency, last_height[currency])
+    exchange_rate_arrays[currency] = \
+        all_exchange_rates[currency].view(np.float64).reshape(-1, 2)
+    if bloom_filter_dir is not None:
+        load_bloom_filters(currency)
+    if tag_index_enabled:
+        load_tag_index(currency)
+
+
+def preload(app):
+    # loads the state of all non-deferred currencies in the uWSGI master,
+    # whose workers share it copy-on-write and only prepare statements on
+    # their own session after the fork; driver connections and threads must
+    # not be inherited, so the master's cluster is shut down again; workers
+    # initialize currencies that failed to load themselves
+    create_session(app)
+    deferred = app.config.get("DEFERRED_CURRENCIES", [])
+    currencies = [currency for currency in currency_mapping.keys()
+                  if currency not in deferred]
+
+    def preload_currency(currency):
+        try:
+            prepare_statements(currency)
+            load_state(currency)
+            preloaded.add(currency)
+        except BaseException as e:
+            print("Preloading %s failed: %s" % (currency, e))
+    if currencies:
+        with ThreadPoolExecutor(len(currencies)) as executor:
+            list(executor.map(preload_currency, currencies))
+    session.cluster.shutdown()
+
+
+def load_bloom_filters(currency):
+    for kind in graphsensebloom.KINDS:
+        path = graphsensebloom.filter_path(bloom_filter_dir, currency, kind)
+        if not os.path.exists(path):
+            continue
+        bloom_filter = graphsensebloom.BloomFilter.load(path)
+        # filters built before the last block would miss newer entries
+        if kind == "address":
+            statistics = execute(statistics_query, currency)
+            height = statistics[0].no_blocks - 1 if statistics else 0
+        else:
+            height = last_height[currency]
+        if bloom_filter.height >= height:
+            bloom_filters[(currency, kind)] = bloom_filter
+        else:
+            print("Ignoring outdated Bloom filter %s" % path)
+
+
+def might_exist(currency, kind, key):
+    bloom_filter = bloom_filters.get((currency, kind))
+    return bloom_filter is None or bloom_filter.might_contain(key)
+
+
+def record_false_positive(currency, kind):
+    bloom_filter = bloom_filters.get((currency, kind))
+    if bloom_filter is not None:
+        bloom_filter.falsePositives += 1
+
+
+def load_tag_index(currency):
+    tag_indexes[currency] = graphsensetags.TagIndex(
+        stream_rows(all_address_tags_query, currency, []),
+        stream_rows(all_cluster_tags_query, currency, []))
+
+
+def refresh_tag_index(currency):
+    try:
+        load_tag_index(currency)
+    except Exception as e:
+        tag_indexes[currency].refreshing = False
+        print("Refreshing tag index of %s failed: %s" % (currency, e))
+
+
+def current_tag_index(currency):
+    # outdated indexes are still used while a thread reloads them
+    tag_index = tag_indexes.get(currency)
+    if tag_index is not None and not tag_index.refreshing and \
+            time.time() - tag_index.loaded > tag_index_refresh:
+        tag_index.refreshing = True
+        threading.Thread(target=refresh_tag_index, args=(currency,),
+                         daemon=True).start()
+    return tag_index
+
+
+def ready_currencies():
+    return [currency for currency in currency_mapping.keys()
+            if init_status.get(currency) == "ready"]
+
+
+def prepare_statements(currency):
+    (raw, transformed) = currency_mapping[currency]
+
+    def prepare(query, keyspace):
+        return session.prepare(query % keyspace)
+
+    address_query[currency] = prepare("SELECT * FROM %s.address WHERE address = ? AND address_prefix = ?", transformed)
+    address_search_query[currency] = prepare("SELECT address FROM %s.address WHERE address_prefix = ?", transformed)
+    address_transactions_query[currency] = prepare("SELECT * FROM %s.address_transactions WHERE address = ? AND address_prefix = ? LIMIT ?", transformed)
+    address_transactions_without_limit_query[currency] = prepare("SELECT * FROM %s.address_transactions WHERE address = ? AND address_prefix = ?", transformed)
+    address_tags_query[currency] = prepare("SELECT * FROM %s.address_tags WHERE address = ?", transformed)
+    address_cluster_query[currency] = prepare("SELECT cluster FROM %s.address_cluster WHERE address = ? AND address_prefix = ?", transformed)
+    address_incoming_relations_query[currency] = prepare("SELECT * FROM %s.address_incoming_relations WHERE dst_address_prefix = ? AND dst_address = ? LIMIT ?", transformed)
+    address_incoming_relations_without_limit_query[currency] = prepare("SELECT * FROM %s.address_incoming_relations WHERE dst_address_prefix = ? AND dst_address = ?", transformed)
+    address_outgoing_relations_query[currency] = prepare("SELECT * FROM %s.address_outgoing_relations WHERE src_address_prefix = ? AND src_address = ? LIMIT ?", transformed)
+    address_outgoing_relations_without_limit_query[currency] = prepare("SELECT * FROM %s.address_outgoing_relations WHERE src_address_prefix = ? AND src_address = ?", transformed)
+    cluster_incoming_relations_query[currency] = prepare("SELECT * FROM %s.cluster_incoming_relations WHERE dst_cluster = ? LIMIT ?", transformed)
+    cluster_incoming_relations_without_limit_query[currency] = prepare("SELECT * FROM %s.cluster_incoming_relations WHERE dst_cluster = ?", transformed)
+    cluster_outgoing_relations_query[currency] = prepare("SELECT * FROM %s.cluster_outgoing_relations WHERE src_cluster = ? LIMIT ?", transformed)
+    cluster_outgoing_relations_without_limit_query[currency] = prepare("SELECT * FROM %s.cluster_outgoing_relations WHERE src_cluster = ?", transformed)
+    cluster_tags_query[currency] = prepare("SELECT * FROM %s.cluster_tags WHERE cluster = ?", transformed)
+    cluster_query[currency] = prepare("SELECT * FROM %s.cluster WHERE cluster = ?", transformed)
+    cluster_addresses_query[currency] = prepare("SELECT * FROM %s.cluster_addresses WHERE cluster = ? LIMIT ?", transformed)
+    cluster_addresses_without_limit_query[currency] = prepare("SELECT * FROM %s.cluster_addresses WHERE cluster = ?", transformed)
+    statistics_query[currency] = prepare("SELECT * FROM %s.summary_statistics LIMIT 1", transformed)
+    cluster_degrees_query[currency] = prepare("SELECT cluster, in_degree, out_degree FROM %s.cluster", transformed)
+    address_degrees_query[currency] = prepare("SELECT address, in_degree, out_degree FROM %s.address", transformed)
+    all_address_tags_query[currency] = prepare("SELECT * FROM %s.address_tags", transformed)
+    all_cluster_tags_query[currency] = prepare("SELECT * FROM %s.cluster_tags", transformed)
+
+    tx_query[currency] = prepare("SELECT * FROM %s.transaction WHERE tx_prefix = ? AND tx_hash = ?", raw)
+    txs_query[currency] = prepare("SELECT * FROM %s.transaction LIMIT ?", raw)
+    transaction_search_query[currency] = prepare("SELECT tx_hash from %s.transaction where tx_prefix = ?", raw)
+    block_transactions_query[currency] = prepare("SELECT * FROM %s.block_transactions WHERE height = ?", raw)
+    block_query[currency] = prepare("SELECT * FROM %s.block WHERE height = ?", raw)
+    blocks_query[currency] = prepare("SELECT * FROM %s.block LIMIT ?", raw)
+    exchange_rates_query[currency] = prepare("SELECT * FROM %s.exchange_rates LIMIT ?", raw)
+    exchange_rate_for_height_query[currency] = prepare("SELECT * FROM %s.exchange_rates WHERE height = ?", raw)
+    block_height_query[currency] = prepare("SELECT height FROM %s.exchange_rates WHERE height = ?", raw)
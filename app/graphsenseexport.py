@@ -0,0 +1,97 @@
+import csv
+import io
+from xml.sax.saxutils import escape, quoteattr
+from cassandra import OperationTimedOut
+import graphsensedao as gd
+
+# Streaming serializations of the relations walked by gd.walk_relations.
+# Edges are deduplicated, nodes are written on their first occurrence; the
+# output stops after max_edges edges or when the request deadline passes.
+# Truncated outputs end with a comment, as GraphML comment or as CSV line
+# starting with #.
+
+graphml_header = """<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns">
+<key id="nodeType" for="node" attr.name="nodeType" attr.type="string"/>
+<key id="received" for="node" attr.name="received" attr.type="long"/>
+<key id="balance" for="node" attr.name="balance" attr.type="long"/>
+<key id="transactions" for="edge" attr.name="transactions" attr.type="long"/>
+<key id="satoshi" for="edge" attr.name="satoshi" attr.type="long"/>
+<key id="eur" for="edge" attr.name="eur" attr.type="double"/>
+<key id="usd" for="edge" attr.name="usd" attr.type="double"/>
+<graph id="G" edgedefault="directed">
+"""
+graphml_footer = "</graph>\n</graphml>\n"
+csv_header = ["source", "target", "transactions", "satoshi", "eur", "usd"]
+
+
+def unique_edges(relations, max_edges, state):
+    seen = set()
+    try:
+        for relation in relations:
+            edge = relation.toJsonEdge()
+            key = (edge["source"], edge["target"])
+            if key in seen:
+                continue
+            if len(seen) >= max_edges:
+                state["truncated"] = True
+                return
+            seen.add(key)
+            yield relation, edge
+    except (gd.DeadlineExceeded, OperationTimedOut):
+        state["truncated"] = True
+
+
+def graphml_data(values):
+    return "".join("<data key=\"%s\">%s</data>" % (key, escape(str(value)))
+                   for (key, value) in values)
+
+
+def graphml_node(node):
+    return "<node id=%s>%s</node>\n" % (
+        quoteattr(node["id"]),
+        graphml_data((key, node[key])
+                     for key in ("nodeType", "received", "balance")))
+
+
+def graphml_edge(edge):
+    value = edge["estimatedValue"]
+    return "<edge source=%s target=%s>%s</edge>\n" % (
+        quoteattr(edge["source"]), quoteattr(edge["target"]),
+        graphml_data([("transactions", edge["transactions"]),
+                      ("satoshi", value["satoshi"]),
+                      ("eur", value["eur"]),
+                      ("usd", value["usd"])]))
+
+
+def graphml(seed_nodes, relations, max_edges, state):
+    nodes = set()
+    yield graphml_header
+    for node in seed_nodes:
+        nodes.add(node["id"])
+        yield graphml_node(node)
+    for (relation, edge) in unique_edges(relations, max_edges, state):
+        node = relation.toJsonNode()
+        if node["id"] not in nodes:
+            nodes.add(node["id"])
+            yield graphml_node(node)
+        yield graphml_edge(edge)
+    if state["truncated"]:
+        yield "<!-- truncated -->\n"
+    yield graphml_footer
+
+
+def csv_row(values):
+    output = io.StringIO()
+    csv.writer(output).writerow(values)
+    return output.getvalue()
+
+
+def edge_list(relations, max_edges, state):
+    yield csv_row(csv_header)
+    for (_, edge) in unique_edges(relations, max_edges, state):
+        value = edge["estimatedValue"]
+        yield csv_row([edge["source"], edge["target"], edge["transactions"],
+                       value["satoshi"], value["eur"], value["usd"]])
+    if state["truncated"]:
+        yield "# truncated\n"
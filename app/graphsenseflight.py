@@ -0,0 +1,141 @@
+import glob
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+# Coalescing of identical concurrent requests: the first caller of a key
+# computes the result, concurrent callers with the same key wait for it and
+# retry if it fails. If a directory is given, workers additionally serialize
+# on a lock file per key, created exclusively by the worker computing the
+# result, and pass the result on in a result file per key. A lock file older
+# than LOCK_TIMEOUT belongs to a worker that died while computing and is
+# removed.
+
+POLL_INTERVAL = 0.01
+CLEANUP_INTERVAL = 60
+LOCK_TIMEOUT = 120
+
+
+class Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.lastCleanup = time.time()
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared = 0
+        self.retried = 0
+
+    def do(self, key, compute, remaining):
+        # remaining() returns the seconds the caller may wait (None for no
+        # limit) and raises once its deadline has passed
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = Call()
+                    self.leaders += 1
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+            while not call.event.wait(remaining()):
+                pass
+            if call.error is None:
+                return call.result
+            # the leader failed, e.g. at its own deadline, so the callers
+            # still waiting compute the result themselves
+            self.retried += 1
+        try:
+            if self.directory is None:
+                call.result = compute()
+            else:
+                call.result = self.do_shared(key, compute, remaining)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def do_shared(self, key, compute, remaining):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, name)
+        lock_path = path + ".lock"
+        start = time.time()
+        while not self.try_lock(lock_path):
+            remaining()
+            time.sleep(POLL_INTERVAL)
+        try:
+            # a result written while waiting for the lock was computed by
+            # another worker for a concurrent request
+            try:
+                if os.path.getmtime(path) >= start:
+                    with open(path, "rb") as fp:
+                        result = pickle.load(fp)
+                    self.shared += 1
+                    return result
+            except FileNotFoundError:
+                # not written yet or removed by the cleanup
+                pass
+            result = compute()
+            with open(path + ".tmp", "wb") as fp:
+                pickle.dump(result, fp)
+            os.rename(path + ".tmp", path)
+        finally:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+        self.cleanup()
+        return result
+
+    def try_lock(self, lock_path):
+        try:
+            os.close(os.open(lock_path,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if os.path.getmtime(lock_path) < time.time() - LOCK_TIMEOUT:
+                os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def cleanup(self):
+        now = time.time()
+        if now - self.lastCleanup < CLEANUP_INTERVAL:
+            return
+        self.lastCleanup = now
+        for path in glob.glob(os.path.join(self.directory, "*")):
+            timeout = LOCK_TIMEOUT if path.endswith(".lock") \
+                else CLEANUP_INTERVAL
+            try:
+                if os.path.getmtime(path) < now - timeout:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def toJson(self):
+        return {
+            "inFlight": len(self.calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "sharedAcrossWorkers": self.shared,
+            "retried": self.retried
+        }
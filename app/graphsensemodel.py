@@ -182,6 +182,28 @@ class AddressTransactions(object):
         self.txIndex = row.tx_index
 
 
+class AddressFlow(object):
+    def __init__(self, timestamp, from_height, to_height, no_transactions,
+                 incoming, outgoing):
+        self.timestamp = timestamp
+        self.fromHeight = from_height
+        self.toHeight = to_height
+        self.noTransactions = no_transactions
+        self.incoming = incoming.__dict__
+        self.outgoing = outgoing.__dict__
+
+
+class BlockBucket(object):
+    def __init__(self, from_height, to_height, no_blocks, no_transactions,
+                 total_input, total_output):
+        self.fromHeight = from_height
+        self.toHeight = to_height
+        self.noBlocks = no_blocks
+        self.noTransactions = no_transactions
+        self.totalInput = total_input.__dict__
+        self.totalOutput = total_output.__dict__
+
+
 class Cluster(object):
     def __init__(self, row, exchange_rate):
         self.cluster = int(row.cluster)
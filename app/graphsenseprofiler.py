@@ -0,0 +1,60 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# (endpoint, rule) of the request each thread is currently serving
+active_requests = {}
+profiler_lock = threading.Lock()
+
+
+def request_started(endpoint, rule):
+    active_requests[threading.get_ident()] = (endpoint, rule)
+
+
+def request_finished():
+    active_requests.pop(threading.get_ident(), None)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def profile(seconds, interval, route=None, all_threads=False):
+    # samples the stacks of all other threads, by default only of threads
+    # serving a request (matching route, if given)
+    own = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for (ident, frame) in sys._current_frames().items():
+            if ident == own:
+                continue
+            current = active_requests.get(ident)
+            if current is None and not all_threads:
+                continue
+            if route is not None and (current is None or
+                                      route not in current):
+                continue
+            stacks[collapse(frame)] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+def to_collapsed(stacks):
+    # input format of flamegraph.pl and speedscope
+    return "".join("%s %d\n" % (stack, count)
+                   for (stack, count) in stacks.most_common())
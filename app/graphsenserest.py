@@ -1,8 +1,25 @@
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort, g, \
+    send_file, stream_with_context
 from flask_cors import CORS
+from graphsensetrace import QueryTrace
 import graphsensedao as gd
+import graphsenseprofiler as gp
+import graphsenseadmission as ga
+import graphsensearchive as gar
+import graphsensecache as gc
+import graphsenseexport as ge
+import graphsenseflight as gf
+import graphsensestore as gs
+import graphsensetags as gt
 import graphsensemodel as gm
 import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from cassandra import OperationTimedOut
+from werkzeug.exceptions import HTTPException
 
 with open("./config.json", "r") as fp:
     config = json.load(fp)
@@ -13,15 +30,255 @@ app.config.from_object(__name__)
 app.config.update(config)
 app.config.from_envvar("GRAPHSENSE_REST_SETTINGS", silent=True)
 currency_mapping = app.config["MAPPING"]
+admission = ga.AdmissionController(
+    app.config.get("MAX_EXPENSIVE_REQUESTS", 2),
+    app.config.get("MAX_EXPENSIVE_REQUESTS_PER_CLIENT", 1),
+    app.config.get("MAX_WAITING_EXPENSIVE_REQUESTS", 1),
+    app.config.get("ADMISSION_QUEUE_TIMEOUT", 2))
+response_cache = gc.LRUCache(app.config.get("RESPONSE_CACHE_SIZE", 10000),
+                             app.config.get("CACHE_TTL", 600))
+# endpoints whose responses only change with new data, not truncated by
+# deadlines or time budgets
+cacheable_endpoints = {
+    "address",
+    "address_cluster",
+    "address_cluster_with_tags",
+    "address_egonet",
+    "address_implicit_tags",
+    "address_tags",
+    "address_with_tags",
+    "block",
+    "block_transactions",
+    "cluster",
+    "cluster_egonet",
+    "cluster_tags",
+    "cluster_with_tags",
+    "transaction"
+}
+warmup_status = {"state": "disabled"}
+warmup_lock = threading.Lock()
+flights = gf.SingleFlight(app.config.get("SINGLE_FLIGHT_DIR"))
+store = gs.MaterializedStore(app.config["MATERIALIZED_STORE"]) \
+    if app.config.get("MATERIALIZED_STORE") else None
+archive = gar.ResponseArchive(
+    app.config["RESPONSE_ARCHIVE_DIR"],
+    app.config.get("RESPONSE_ARCHIVE_MAX_BYTES", 1 << 30),
+    app.config.get("RESPONSE_ARCHIVE_GZIP", True)) \
+    if app.config.get("RESPONSE_ARCHIVE_DIR") else None
+
+
+def single_flight(f):
+    # identical concurrent requests share the response of the first one
+    @wraps(f)
+    def coalesced(**kwargs):
+        if g.get("trace_requested"):
+            return f(**kwargs)
+        key = (request.endpoint, tuple(sorted(kwargs.items())),
+               tuple(sorted(request.args.items(multi=True))))
+
+        def compute():
+            # aborts are responses shared with the waiting requests, other
+            # errors make them retry
+            try:
+                response = app.make_response(f(**kwargs))
+            except HTTPException as e:
+                response = app.make_response(app.handle_http_exception(e))
+            return (response.get_data(), response.status_code,
+                    response.mimetype)
+
+        (data, status, mimetype) = flights.do(key, compute, gd.remaining_time)
+        return Response(data, status=status, mimetype=mimetype)
+    return coalesced
+
+
+def is_admin():
+    token = app.config.get("ADMIN_TOKEN")
+    return token is not None and \
+        request.headers.get("X-Admin-Token") == token
+
+
+@app.before_request
+def start_deadline():
+    # exports stream for longer than other requests take
+    default = app.config.get("EXPORT_DEADLINE", 600) \
+        if request.endpoint == "export" \
+        else app.config.get("DEFAULT_REQUEST_DEADLINE", 30)
+    seconds = app.config.get("REQUEST_DEADLINES", {}).get(
+        request.endpoint, default)
+    requested = request.headers.get("X-Request-Deadline")
+    if requested is not None:
+        try:
+            seconds = min(float(requested),
+                          max(app.config.get("MAX_REQUEST_DEADLINE", 60),
+                              seconds))
+        except ValueError:
+            abort(404, "Invalid X-Request-Deadline value")
+    g.deadline = time.time() + seconds
+
+
+@app.before_request
+def register_request():
+    gp.request_started(request.endpoint,
+                       request.url_rule.rule if request.url_rule else None)
+
+
+@app.teardown_request
+def unregister_request(exception):
+    gp.request_finished()
+
+
+@app.before_request
+def start_trace():
+    requested = request.args.get("trace") or request.headers.get("X-Trace")
+    if requested and requested != "0" and is_admin():
+        g.trace_requested = True
+        g.trace = QueryTrace(cassandra_tracing=requested == "cassandra")
+    elif random.random() < app.config.get("SLOW_REQUEST_SAMPLE_RATE", 0):
+        g.trace_requested = False
+        g.trace = QueryTrace()
+
+
+@app.before_request
+def cached_response():
+    if request.endpoint not in cacheable_endpoints or \
+            g.get("trace_requested") or \
+            request.environ.get("graphsense.internal"):
+        return None
+    cached = response_cache.get(request.full_path)
+    if cached is None:
+        return None
+    g.cache_hit = True
+    (data, mimetype) = cached
+    return Response(data, mimetype=mimetype)
+
+
+@app.before_request
+def materialized_response():
+    if store is None or request.endpoint not in gs.materialized_endpoints \
+            or g.get("trace_requested") or \
+            request.environ.get("graphsense.internal"):
+        return None
+    currency = request.view_args["currency"]
+    if currency not in gd.last_height:
+        return None
+    found = store.get(currency, request.full_path, gd.last_height[currency])
+    if found is None:
+        return None
+    g.cache_hit = True
+    (data, mimetype) = found
+    return Response(data, mimetype=mimetype)
+
+
+def archive_key():
+    # only responses without parameters are archived
+    if archive is None or request.endpoint not in gar.archived_endpoints \
+            or request.args or g.get("trace_requested"):
+        return None
+    currency = request.view_args["currency"]
+    if currency not in gd.last_height:
+        return None
+    if request.endpoint == "transaction":
+        return currency, request.view_args["txHash"].lower()
+    return currency, str(request.view_args["height"])
+
+
+def is_final(height):
+    currency = request.view_args["currency"]
+    return height <= gd.last_height[currency] - \
+        app.config.get("FINAL_CONFIRMATIONS", 6)
+
+
+@app.before_request
+def archived_response():
+    key = archive_key()
+    if key is None:
+        return None
+    found = archive.lookup(key[0], request.endpoint, key[1],
+                           request.accept_encodings["gzip"] > 0)
+    if found is None:
+        return None
+    g.cache_hit = True
+    (path, encoding) = found
+    response = send_file(path, mimetype="application/json")
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.before_request
+def admit_request():
+    if request.environ.get("graphsense.internal"):
+        return None
+    if not ga.is_expensive(request.endpoint, request.args,
+                           app.config.get("MAX_CHEAP_ROWS", 1000)):
+        return None
+    client = request.headers.get(app.config.get("CLIENT_HEADER", ""),
+                                 request.remote_addr)
+    if not admission.acquire(client):
+        response = jsonify({"message": "Too many expensive requests"})
+        response.status_code = 429
+        response.headers["Retry-After"] = \
+            str(app.config.get("ADMISSION_RETRY_AFTER", 5))
+        return response
+    g.admitted_client = client
+
+
+@app.teardown_request
+def release_request(exception):
+    if "admitted_client" in g:
+        admission.release(g.pop("admitted_client"))
+
+
+@app.after_request
+def archive_response(response):
+    if response.status_code != 200 or g.get("cache_hit"):
+        return response
+    key = archive_key()
+    if key is None:
+        return response
+    height = response.get_json()["height"] \
+        if request.endpoint == "transaction" else request.view_args["height"]
+    if height is not None and is_final(height):
+        try:
+            archive.put(key[0], request.endpoint, key[1], response.get_data())
+        except OSError as e:
+            app.logger.warning("Archiving %s failed: %s", request.path, e)
+    return response
+
+
+@app.after_request
+def cache_response(response):
+    # empty objects of entities not found (yet) are not cached
+    if request.endpoint in cacheable_endpoints and \
+            response.status_code == 200 and not g.get("cache_hit") and \
+            not g.get("trace_requested") and \
+            response.get_data().strip() != b"{}":
+        response_cache.put(request.full_path,
+                           (response.get_data(), response.mimetype))
+    return response
+
+
+@app.after_request
+def finish_trace(response):
+    trace = g.get("trace")
+    if trace is None:
+        return response
+    if trace.elapsed() > app.config.get("SLOW_REQUEST_MS", 1000):
+        app.logger.warning("Slow request %s (%s): %s", request.full_path,
+                           trace.summary(), json.dumps(trace.toJson()))
+    if g.trace_requested:
+        response.headers["X-Query-Trace"] = trace.summary()
+        data = response.get_json(silent=True)
+        if isinstance(data, dict):
+            data["trace"] = trace.toJson()
+            response.set_data(json.dumps(data))
+    return response
 
 
 @app.route("/")
 def index():
-    statistics = dict()
-    for currency in currency_mapping.keys():
-        if len(currency.split("_")) == 1:
-            statistics[currency] = gd.query_statistics(currency)
-    return jsonify(statistics)
+    return jsonify(gd.query_all_statistics())
 
 
 @app.route("/<currency>/exchangerates")
@@ -48,9 +305,24 @@ def block(currency, height):
     return jsonify(block)
 
 
+def resolve_arg():
+    resolve = request.args.get("resolve")
+    if not resolve:
+        return None
+    resolve = set(resolve.split(","))
+    if not resolve.issubset(("cluster", "tags")):
+        abort(404, "Invalid resolve value - has to be cluster, tags or both")
+    return resolve
+
+
 @app.route("/<currency>/block/<int:height>/transactions")
 def block_transactions(currency, height):
-    block_transactions = gd.query_block_transactions(currency, height)
+    resolve = resolve_arg()
+    if resolve:
+        block_transactions = gd.query_block_transactions_resolved(
+            currency, height, resolve)
+    else:
+        block_transactions = gd.query_block_transactions(currency, height)
     if not block_transactions:
         abort(404, "Block height %d not found" % height)
     return jsonify(block_transactions)
@@ -58,6 +330,24 @@ def block_transactions(currency, height):
 
 @app.route("/<currency>/blocks")
 def blocks(currency):
+    start = request.args.get("from")
+    end = request.args.get("to")
+    latest = request.args.get("latest")
+    if start is not None or end is not None or latest is not None:
+        try:
+            start = int(start) if start is not None else None
+            end = int(end) if end is not None else None
+            latest = int(latest) if latest is not None else 10
+        except Exception:
+            abort(404, "Invalid block range")
+        if latest < 1 or (start is not None and end is not None and
+                          start > end):
+            abort(404, "Invalid block range")
+        blocks = gd.query_block_range(currency, start, end, latest)
+        return jsonify({
+            "nextPage": None,
+            "blocks": blocks
+        })
     page_state = request.args.get("page")
     (page_state, blocks) = gd.query_blocks(currency, page_state)
     return jsonify({
@@ -66,11 +356,41 @@ def blocks(currency):
     })
 
 
+@app.route("/<currency>/blocks/stats")
+@single_flight
+def block_stats(currency):
+    try:
+        start = request.args.get("from")
+        end = request.args.get("to")
+        start_timestamp = request.args.get("fromTimestamp")
+        end_timestamp = request.args.get("toTimestamp")
+        start = int(start) if start is not None else None
+        end = int(end) if end is not None else None
+        bucket = int(request.args.get("bucket", 1))
+        if start_timestamp is not None:
+            # the first block at or after the timestamp
+            start = gd.query_height_for_timestamp(currency,
+                                                  int(start_timestamp) - 1)
+            start = 0 if start is None else start + 1
+        if end_timestamp is not None:
+            end = gd.query_height_for_timestamp(currency, int(end_timestamp))
+            if end is None:
+                abort(404, "No block before timestamp %s" % end_timestamp)
+    except ValueError:
+        abort(404, "Invalid block range")
+    if bucket < 1 or (start is not None and end is not None and start > end):
+        abort(404, "Invalid block range")
+    return jsonify(gd.query_block_stats(currency, start, end, bucket))
+
+
 @app.route("/<currency>/tx/<txHash>")
 def transaction(currency, txHash):
+    resolve = resolve_arg()
     transaction = gd.query_transaction(currency, txHash)
     if not transaction:
         abort(404, "Transaction id %s not found" % txHash)
+    if resolve:
+        gd.resolve_transactions(currency, [transaction], resolve)
     return jsonify(transaction)
 
 
@@ -84,6 +404,101 @@ def transactions(currency):
     })
 
 
+@app.route("/ready")
+def ready():
+    status = {currency: gd.init_status.get(currency, "pending")
+              for currency in currency_mapping.keys()}
+    ready = all(state in ("ready", "deferred") for state in status.values()) \
+        and warmup_status["state"] in ("disabled", "done")
+    response = jsonify({"ready": ready, "currencies": status,
+                        "warmup": warmup_status})
+    response.status_code = 200 if ready else 503
+    return response
+
+
+@app.route("/admin/profile")
+def admin_profile():
+    if not is_admin():
+        abort(403, "Admin token required")
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval = float(request.args.get("interval", 5)) / 1000
+    except Exception:
+        abort(404, "Invalid seconds or interval value")
+    if not 0 < seconds <= app.config.get("MAX_PROFILE_SECONDS", 60) or \
+            interval <= 0:
+        abort(404, "Invalid seconds or interval value")
+    if not gp.profiler_lock.acquire(blocking=False):
+        abort(409, "Profiler is already running")
+    try:
+        (samples, stacks) = gp.profile(
+            seconds, interval, request.args.get("route"),
+            request.args.get("threads") == "all")
+    finally:
+        gp.profiler_lock.release()
+    if request.args.get("format") == "json":
+        return jsonify({
+            "samples": samples,
+            "stacks": [{"stack": stack, "count": count}
+                       for (stack, count) in stacks.most_common()]
+        })
+    return Response(gp.to_collapsed(stacks), mimetype="text/plain")
+
+
+@app.route("/admin/bloomfilters")
+def admin_bloom_filters():
+    if not is_admin():
+        abort(403, "Admin token required")
+    filters = {}
+    for ((currency, kind), bloom_filter) in gd.bloom_filters.items():
+        filters.setdefault(currency, {})[kind] = bloom_filter.toJson()
+    return jsonify(filters)
+
+
+@app.route("/admin/caches")
+def admin_caches():
+    if not is_admin():
+        abort(403, "Admin token required")
+    return jsonify({
+        "singleFlight": flights.toJson(),
+        "response": response_cache.toJson(),
+        "address": gd.address_cache.toJson(),
+        "cluster": gd.cluster_cache.toJson(),
+        "balance": gd.balance_cache.toJson(),
+        "blockStats": gd.block_stats_cache.toJson(),
+        "materialized": store.toJson() if store is not None else None,
+        "archive": archive.toJson() if archive is not None else None,
+        "tags": {currency: tag_index.toJson()
+                 for (currency, tag_index) in gd.tag_indexes.items()}
+    })
+
+
+@app.route("/search")
+def global_search():
+    expression = request.args.get("q")
+    if not expression:
+        abort(404, "Expression parameter not provided")
+    limit = request.args.get("limit")
+    if not limit:
+        limit = 50
+    else:
+        try:
+            limit = int(limit)
+        except Exception:
+            abort(404, "Invalid limit value")
+    if len(expression) < 5:
+        # prefix lookups need at least five characters
+        results, incomplete = [], []
+    else:
+        results, incomplete = gd.query_global_search(
+            expression, limit, min(app.config.get("SEARCH_DEADLINE", 5),
+                                   gd.remaining_time()))
+    return jsonify({
+        "results": results,
+        "incomplete": incomplete
+    })
+
+
 @app.route("/<currency>/search")
 def search(currency):
     expression = request.args.get("q")
@@ -123,7 +538,35 @@ def search(currency):
     })
 
 
+@app.route("/<currency>/tags/search")
+def tag_search(currency):
+    expression = request.args.get("q")
+    if not expression:
+        abort(404, "Expression parameter not provided")
+    field = request.args.get("field")
+    if field is not None and field not in gt.search_fields:
+        abort(404, "Invalid field - has to be one of %s" %
+              ", ".join(gt.search_fields))
+    try:
+        offset = int(request.args.get("page", 0))
+        pagesize = int(request.args.get("pagesize", 100))
+    except Exception:
+        abort(404, "Invalid page or pagesize value")
+    if offset < 0 or pagesize < 1:
+        abort(404, "Invalid page or pagesize value")
+    (total, results) = gd.query_tag_search(
+        currency, expression, [field] if field else gt.search_fields,
+        offset, pagesize)
+    return jsonify({
+        "nextPage": str(offset + pagesize)
+        if offset + pagesize < total else None,
+        "total": total,
+        "results": results
+    })
+
+
 @app.route("/<currency>/address/<address>")
+@single_flight
 def address(currency, address):
     if not address:
         abort(404, "Address not provided")
@@ -133,6 +576,7 @@ def address(currency, address):
 
 
 @app.route("/<currency>/address_with_tags/<address>")
+@single_flight
 def address_with_tags(currency, address):
     if not address:
         abort(404, "Address not provided")
@@ -160,6 +604,10 @@ def address_transactions(currency, address):
         except Exception:
             abort(404, "Invalid pagesize value")
 
+    expand = request.args.get("expand")
+    if expand is not None and expand != "tx":
+        abort(404, "Invalid expand value - has to be tx")
+
     page_state = request.args.get("page")
     (page_state, rows) = gd.query_address_transactions(
         currency, page_state, address, pagesize, limit)
@@ -167,12 +615,49 @@ def address_transactions(currency, address):
                row, gd.query_exchange_rate_for_height(currency, row.height)
            ).__dict__
            for row in rows]
+    if expand:
+        for (tx, transaction) in zip(txs, gd.query_transactions_by_hash(
+                currency, [row.tx_hash for row in rows])):
+            tx["transaction"] = transaction
     return jsonify({
         "nextPage": page_state.hex() if page_state is not None else None,
         "transactions": txs
     })
 
 
+@app.route("/<currency>/address/<address>/flows")
+@single_flight
+def address_flows(currency, address):
+    interval = request.args.get("interval", "day")
+    if interval not in ("day", "week", "month"):
+        abort(404, "invalid interval value - has to be day, week or month")
+    (flows, truncated) = gd.query_address_flows(currency, address, interval)
+    return jsonify({
+        "interval": interval,
+        "flows": flows,
+        "truncated": truncated
+    })
+
+
+@app.route("/<currency>/address/<address>/balance")
+@single_flight
+def address_balance(currency, address):
+    height = request.args.get("height")
+    timestamp = request.args.get("timestamp")
+    if height is not None and timestamp is not None:
+        abort(404, "Either height or timestamp can be provided")
+    try:
+        height = int(height) if height is not None else None
+        timestamp = int(timestamp) if timestamp is not None else None
+    except Exception:
+        abort(404, "Invalid height or timestamp value")
+    if timestamp is not None:
+        height = gd.query_height_for_timestamp(currency, timestamp)
+        if height is None:
+            abort(404, "No block before timestamp %d" % timestamp)
+    return jsonify(gd.query_address_balance(currency, address, height))
+
+
 @app.route("/<currency>/address/<address>/tags")
 def address_tags(currency, address):
     if not address:
@@ -213,6 +698,7 @@ def address_cluster_with_tags(currency, address):
 
 
 @app.route("/<currency>/address/<address>/egonet")
+@single_flight
 def address_egonet(currency, address):
     direction = request.args.get("direction")
     if not direction:
@@ -223,22 +709,51 @@ def address_egonet(currency, address):
         limit = 50
     else:
         limit = int(limit)
+    focus_address = gd.query_address(currency, address)
+    if focus_address is None:
+        abort(404, "Address %s not found" % address)
+    _, incoming = gd.query_address_incoming_relations(
+        currency, None, address, None, int(limit))
+    _, outgoing = gd.query_address_outgoing_relations(
+        currency, None, address, None, int(limit))
+    egoNet = gm.AddressEgoNet(
+        focus_address,
+        gd.query_address_tags(currency, address),
+        gd.query_implicit_tags(currency, address),
+        incoming,
+        outgoing
+    )
+    return jsonify(egoNet.construct(address, direction))
+
+
+def neighbor_filters():
+    # returns None unless filtering or sorting is requested
+    if not ga.neighbor_filter_args.intersection(request.args):
+        return None
+    order = request.args.get("sort", "value")
+    if order not in gd.neighbor_orders:
+        abort(404, "Invalid sort value - has to be one of %s" %
+              ", ".join(gd.neighbor_orders))
     try:
-        _, incoming = gd.query_address_incoming_relations(
-            currency, None, address, None, int(limit))
-        _, outgoing = gd.query_address_outgoing_relations(
-            currency, None, address, None, int(limit))
-        egoNet = gm.AddressEgoNet(
-            gd.query_address(currency, address),
-            gd.query_address_tags(currency, address),
-            gd.query_implicit_tags(currency, address),
-            incoming,
-            outgoing
-        )
-        ret = egoNet.construct(address, direction)
+        n = int(request.args.get("top", 100))
+        min_value = int(request.args.get("minValue", 0))
+        min_transactions = int(request.args.get("minTransactions", 0))
     except Exception:
-        ret = {}
-    return jsonify(ret)
+        abort(404, "Invalid top, minValue or minTransactions value")
+    if n < 1 or n > app.config.get("MAX_TOP_N", 1000):
+        abort(404, "Invalid top value")
+    tagged = request.args.get("tagged") in ("1", "true")
+    return n, order, min_value, min_transactions, tagged
+
+
+def top_neighbors(currency, kind, node, is_outgoing, filters):
+    (neighbors, truncated) = gd.query_neighbors_top(
+        currency, kind, node, "out" if is_outgoing else "in", *filters)
+    return jsonify({
+        "nextPage": None,
+        "neighbors": [row.toJson() for row in neighbors],
+        "truncated": truncated
+    })
 
 
 @app.route("/<currency>/address/<address>/neighbors")
@@ -252,6 +767,10 @@ def address_neighbors(currency, address):
         isOutgoing = True
     else:
         abort(404, "invalid direction value - has to be either in or out")
+    filters = neighbor_filters()
+    if filters is not None:
+        return top_neighbors(currency, "address", address, isOutgoing,
+                             filters)
 
     limit = request.args.get("limit")
     if limit is not None:
@@ -280,6 +799,7 @@ def address_neighbors(currency, address):
 
 
 @app.route("/<currency>/cluster/<cluster>")
+@single_flight
 def cluster(currency, cluster):
     if not cluster:
         abort(404, "Cluster not provided")
@@ -292,6 +812,7 @@ def cluster(currency, cluster):
 
 
 @app.route("/<currency>/cluster_with_tags/<cluster>")
+@single_flight
 def cluster_with_tags(currency, cluster):
     if not cluster:
         abort(404, "Cluster id not provided")
@@ -313,6 +834,7 @@ def cluster_tags(currency, cluster):
 
 
 @app.route("/<currency>/cluster/<cluster>/addresses")
+@single_flight
 def cluster_addresses(currency, cluster):
     if not cluster:
         abort(404, "Cluster not provided")
@@ -341,7 +863,35 @@ def cluster_addresses(currency, cluster):
         })
 
 
+@app.route("/<currency>/cluster/<cluster>/addresses/top")
+@single_flight
+def cluster_addresses_top(currency, cluster):
+    try:
+        cluster = int(cluster)
+    except Exception:
+        abort(404, "Invalid cluster ID")
+    order = request.args.get("by", "balance")
+    if order not in gd.cluster_address_keys:
+        abort(404, "Invalid order - has to be one of %s" %
+              ", ".join(gd.cluster_address_keys))
+    n = request.args.get("n", 100)
+    try:
+        n = int(n)
+    except Exception:
+        abort(404, "Invalid n value")
+    if n < 1 or n > app.config.get("MAX_TOP_N", 1000):
+        abort(404, "Invalid n value")
+    (addresses, summary, truncated) = gd.query_cluster_addresses_top(
+        currency, cluster, n, order)
+    return jsonify({
+        "addresses": addresses,
+        "summary": summary,
+        "truncated": truncated
+        })
+
+
 @app.route("/<currency>/cluster/<cluster>/egonet")
+@single_flight
 def cluster_egonet(currency, cluster):
     direction = request.args.get("direction")
     if not cluster:
@@ -361,17 +911,78 @@ def cluster_egonet(currency, cluster):
             limit = int(limit)
         except Exception:
             abort(404, "Invalid limit value")
+    # relation tables are keyed by the text form of cluster IDs
+    focus_cluster = gd.query_cluster(currency, cluster)
+    if focus_cluster is None:
+        abort(404, "Cluster %s not found" % cluster)
+    _, incoming = gd.query_cluster_incoming_relations(
+        currency, None, cluster, None, limit)
+    _, outgoing = gd.query_cluster_outgoing_relations(
+        currency, None, cluster, None, limit)
+    egoNet = gm.ClusterEgoNet(
+        focus_cluster,
+        gd.query_cluster_tags(currency, cluster),
+        incoming,
+        outgoing
+    )
+    return jsonify(egoNet.construct(cluster, direction))
+
+
+@app.route("/<currency>/export")
+def export(currency):
+    clusters = request.args.get("clusters")
+    addresses = request.args.get("addresses")
+    if bool(clusters) == bool(addresses):
+        abort(404, "Either clusters or addresses have to be provided")
+    kind = "cluster" if clusters else "address"
+    seeds = (clusters or addresses).split(",")
+    if kind == "cluster":
+        # relation tables are keyed by the text form of cluster IDs
+        try:
+            seeds = [str(int(cluster)) for cluster in seeds]
+        except Exception:
+            abort(404, "Invalid cluster ID")
+    direction = request.args.get("direction", "both")
+    if direction not in ("in", "out", "both"):
+        abort(404, "invalid direction value - has to be in, out or both")
+    directions = ("in", "out") if direction == "both" else (direction,)
+    output_format = request.args.get("format", "graphml")
+    if output_format not in ("graphml", "csv"):
+        abort(404, "invalid format value - has to be graphml or csv")
     try:
-        egoNet = gm.ClusterEgoNet(
-            gd.query_cluster(currency, cluster),
-            gd.query_cluster_tags(currency, cluster),
-            gd.query_cluster_incoming_relations(currency, cluster, int(limit)),
-            gd.query_cluster_outgoing_relations(currency, cluster, int(limit))
-        )
-        ret = egoNet.construct(cluster, direction)
+        depth = int(request.args.get("depth", 1))
+        limit = int(request.args.get("limit", 1000))
     except Exception:
-        ret = {}
-    return jsonify(ret)
+        abort(404, "Invalid depth or limit value")
+    if not 1 <= depth <= app.config.get("MAX_EXPORT_DEPTH", 3) or limit < 1:
+        abort(404, "Invalid depth or limit value")
+
+    # errors have to be raised before the response starts streaming
+    gd.check_currency(currency)
+    seed_nodes = []
+    for seed in seeds:
+        node = gd.query_cluster(currency, seed) if kind == "cluster" \
+            else gd.query_address(currency, seed)
+        if node is None:
+            abort(404, "%s %s not found" % (kind.capitalize(), seed))
+        seed_nodes.append({
+            "id": seed,
+            "nodeType": kind,
+            "received": node.totalReceived["satoshi"],
+            "balance": (node.totalReceived["satoshi"] -
+                        node.totalSpent["satoshi"])
+        })
+    state = {"truncated": False}
+    relations = gd.walk_relations(
+        currency, kind, seeds, depth, directions, limit,
+        app.config.get("MAX_EXPORT_NODES", 100000), state)
+    max_edges = app.config.get("MAX_EXPORT_EDGES", 500000)
+    if output_format == "csv":
+        return Response(stream_with_context(
+            ge.edge_list(relations, max_edges, state)), mimetype="text/csv")
+    return Response(stream_with_context(
+        ge.graphml(seed_nodes, relations, max_edges, state)),
+        mimetype="application/xml")
 
 
 @app.route("/<currency>/cluster/<cluster>/neighbors")
@@ -385,6 +996,14 @@ def cluster_neighbors(currency, cluster):
         isOutgoing = True
     else:
         abort(404, "invalid direction value - has to be either in or out")
+    filters = neighbor_filters()
+    if filters is not None:
+        try:
+            cluster = str(int(cluster))
+        except Exception:
+            abort(404, "Invalid cluster ID")
+        return top_neighbors(currency, "cluster", cluster, isOutgoing,
+                             filters)
 
     limit = request.args.get("limit")
     if limit is not None:
@@ -418,6 +1037,56 @@ def cluster_neighbors(currency, cluster):
     })
 
 
+def is_cacheable_path(path):
+    try:
+        (endpoint, _) = app.url_map.bind("").match(path.split("?")[0])
+    except Exception:
+        return False
+    return endpoint in cacheable_endpoints
+
+
+def warmup():
+    # requests the hottest paths of the access logs through the application,
+    # which fills the response and entity caches
+    try:
+        paths = gc.hot_paths(app.config.get("WARMUP_ACCESS_LOGS", []),
+                             app.config.get("WARMUP_HOT_KEYS_FILE"),
+                             app.config.get("WARMUP_KEYS", 500),
+                             app.config.get("WARMUP_LOG_BYTES", 64 * 2**20),
+                             is_cacheable_path)
+        warmup_status.update(paths=len(paths), warmed=0, failed=0)
+
+        def get(path):
+            response = app.test_client().get(
+                path, environ_overrides={"graphsense.internal": True})
+            key = "warmed" if response.status_code == 200 else "failed"
+            with warmup_lock:
+                warmup_status[key] += 1
+
+        with ThreadPoolExecutor(
+                app.config.get("WARMUP_CONCURRENCY", 8)) as executor:
+            list(executor.map(get, paths))
+    except Exception:
+        app.logger.exception("Cache warmup failed")
+    warmup_status["state"] = "done"
+
+
+def start_warmup():
+    if not app.config.get("WARMUP_ACCESS_LOGS") and \
+            not app.config.get("WARMUP_HOT_KEYS_FILE"):
+        return
+    warmup_status["state"] = "running"
+    threading.Thread(target=warmup, daemon=True).start()
+
+
+@app.errorhandler(gd.DeadlineExceeded)
+@app.errorhandler(OperationTimedOut)
+def deadline_exceeded(error):
+    response = jsonify({"message": "Request deadline exceeded"})
+    response.status_code = 504
+    return response
+
+
 @app.errorhandler(400)
 def custom400(error):
     return jsonify({"message": error.description})
@@ -425,4 +1094,5 @@ def custom400(error):
 
 if __name__ == "__main__":
     gd.connect(app)
+    start_warmup()
     app.run(port=9000, debug=True, processes=1)
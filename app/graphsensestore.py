@@ -0,0 +1,149 @@
+import argparse
+import sqlite3
+import threading
+import time
+
+# Local store of precomputed responses (egonets and first neighbor pages) of
+# the highest-degree clusters and addresses, whose relation partitions are
+# too large to be read on every request. The store is filled by
+#
+#     python graphsensestore.py /srv/graphsense-rest/materialized.db
+#
+# which rebuilds the responses of a currency whenever its last block height
+# changes. Workers serve the latest build unless it is older than the height
+# they loaded.
+
+materialized_endpoints = {
+    "address_egonet",
+    "address_neighbors",
+    "cluster_egonet",
+    "cluster_neighbors"
+}
+cluster_templates = [
+    "/{currency}/cluster/{id}/egonet",
+    "/{currency}/cluster/{id}/neighbors?direction=in",
+    "/{currency}/cluster/{id}/neighbors?direction=out"
+]
+address_templates = [
+    "/{currency}/address/{id}/egonet",
+    "/{currency}/address/{id}/neighbors?direction=in",
+    "/{currency}/address/{id}/neighbors?direction=out"
+]
+
+
+def store_key(path):
+    # same as request.full_path
+    return path if "?" in path else path + "?"
+
+
+class MaterializedStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        with sqlite3.connect(path) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS heights "
+                               "(currency TEXT PRIMARY KEY, height INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                               "(currency TEXT, key TEXT, data BLOB, "
+                               "mimetype TEXT, PRIMARY KEY (currency, key))")
+
+    def connection(self):
+        # sqlite connections must not be shared between threads
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(self.path)
+        return self.local.connection
+
+    def height(self, currency):
+        row = self.connection().execute(
+            "SELECT height FROM heights WHERE currency = ?",
+            (currency,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, currency, key, min_height):
+        row = self.connection().execute(
+            "SELECT data, mimetype FROM responses JOIN heights "
+            "USING (currency) WHERE currency = ? AND key = ? AND height >= ?",
+            (currency, key, min_height)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def replace(self, currency, height, responses):
+        # readers see either all old or all new responses of a currency
+        connection = self.connection()
+        with connection:
+            connection.execute("DELETE FROM responses WHERE currency = ?",
+                               (currency,))
+            connection.executemany(
+                "INSERT INTO responses VALUES (?, ?, ?, ?)",
+                [(currency, key, data, mimetype)
+                 for (key, data, mimetype) in responses])
+            connection.execute("INSERT OR REPLACE INTO heights VALUES (?, ?)",
+                               (currency, height))
+
+    def toJson(self):
+        connection = self.connection()
+        return {
+            "heights": dict(connection.execute(
+                "SELECT currency, height FROM heights").fetchall()),
+            "responses": dict(connection.execute(
+                "SELECT currency, count(*) FROM responses "
+                "GROUP BY currency").fetchall()),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+def materialize(app, gd, store, currency, clusters, addresses):
+    client = app.test_client()
+    paths = [template.format(currency=currency, id=cluster)
+             for cluster in gd.query_top_degree(currency, "cluster", clusters)
+             for template in cluster_templates] + \
+        [template.format(currency=currency, id=address)
+         for address in gd.query_top_degree(currency, "address", addresses)
+         for template in address_templates]
+    responses = []
+    for path in paths:
+        response = client.get(path,
+                              environ_overrides={"graphsense.internal": True})
+        if response.status_code == 200:
+            responses.append((store_key(path), response.get_data(),
+                              response.mimetype))
+    store.replace(currency, gd.last_height[currency], responses)
+    return len(responses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute egonets and neighbors of high-degree nodes")
+    parser.add_argument("database")
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--addresses", type=int, default=1000)
+    parser.add_argument("--interval", type=int, default=0,
+                        help="seconds between checks for new blocks, "
+                             "0 to run once")
+    args = parser.parse_args()
+
+    from graphsenserest import app
+    import graphsensedao as gd
+    gd.connect(app)
+    store = MaterializedStore(args.database)
+    while True:
+        for currency in gd.ready_currencies():
+            height = gd.query_last_block_height(currency)
+            if height == store.height(currency):
+                continue
+            # reload exchange rates and height of the new tip
+            gd.load_state(currency)
+            count = materialize(app, gd, store, currency, args.clusters,
+                                args.addresses)
+            print("Materialized %d responses of %s at height %d" %
+                  (count, currency, gd.last_height[currency]))
+        if not args.interval:
+            break
+        time.sleep(args.interval)
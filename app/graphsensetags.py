@@ -0,0 +1,95 @@
+import re
+import sys
+import time
+from bisect import bisect_left
+import graphsensemodel as gm
+
+# fields with few distinct values, shared between all tags
+interned_fields = ("actorCategory", "source", "sourceUri", "tagUri", "tag")
+search_fields = ("tag", "actorCategory", "source", "description")
+token_pattern = re.compile(r"\w+")
+
+
+def compact_tag(row):
+    tag = gm.Tag(row).__dict__
+    for field in interned_fields:
+        if isinstance(tag[field], str):
+            tag[field] = sys.intern(tag[field])
+    return tag
+
+
+def tokenize(text):
+    return token_pattern.findall(text.lower()) if isinstance(text, str) \
+        else []
+
+
+class TagIndex(object):
+    def __init__(self, address_rows, cluster_rows):
+        self.loaded = time.time()
+        self.refreshing = False
+        self.addressTags = {}
+        self.clusterTags = {}
+        for row in address_rows:
+            self.addressTags.setdefault(row.address, []).append(
+                compact_tag(row))
+        for row in cluster_rows:
+            self.clusterTags.setdefault(row.cluster, []).append(
+                compact_tag(row))
+        self.build_search_index()
+
+    def build_search_index(self):
+        # tokens of each search field map to the positions of the tagged
+        # entities, sorted tokens allow prefix lookups
+        self.entities = sorted(
+            [("address", address) for address in self.addressTags] +
+            [("cluster", cluster) for cluster in self.clusterTags])
+        self.tokens = {field: {} for field in search_fields}
+        for (position, (kind, key)) in enumerate(self.entities):
+            tags = self.addressTags[key] if kind == "address" \
+                else self.clusterTags[key]
+            for tag in tags:
+                for field in search_fields:
+                    for token in tokenize(tag[field]):
+                        self.tokens[field].setdefault(
+                            sys.intern(token), set()).add(position)
+        self.sortedTokens = {field: sorted(tokens)
+                             for (field, tokens) in self.tokens.items()}
+
+    def matching_positions(self, term, fields):
+        positions = set()
+        for field in fields:
+            tokens = self.sortedTokens[field]
+            i = bisect_left(tokens, term)
+            while i < len(tokens) and tokens[i].startswith(term):
+                positions |= self.tokens[field][tokens[i]]
+                i += 1
+        return positions
+
+    def search(self, expression, fields, offset, limit):
+        # every term has to be a prefix of a token of one of the fields
+        matches = None
+        for term in tokenize(expression):
+            positions = self.matching_positions(term, fields)
+            matches = positions if matches is None else matches & positions
+            if not matches:
+                break
+        matches = sorted(matches or ())
+        return len(matches), [self.entities[position] for position
+                              in matches[offset:offset + limit]]
+
+    def tagged(self, kind, key):
+        return key in (self.addressTags if kind == "address"
+                       else self.clusterTags)
+
+    def address_tags(self, address):
+        return list(self.addressTags.get(address, ()))
+
+    def cluster_tags(self, cluster):
+        return list(self.clusterTags.get(cluster, ()))
+
+    def toJson(self):
+        return {
+            "loaded": int(self.loaded),
+            "addresses": len(self.addressTags),
+            "clusters": len(self.clusterTags)
+        }
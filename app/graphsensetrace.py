@@ -0,0 +1,71 @@
+import time
+from flask import g, has_request_context
+
+
+class QueryTrace(object):
+    def __init__(self, cassandra_tracing=False):
+        self.cassandraTracing = cassandra_tracing
+        self.start = time.time()
+        self.queries = []
+
+    def record(self, statement, rows, elapsed):
+        future = rows.response_future
+        entry = {
+            "statement": statement.prepared_statement.query_string,
+            "params": [serialize_param(value)
+                       for value in (statement.values or [])],
+            "rows": len(rows.current_rows),
+            "pages": 1,
+            "coordinator": str(getattr(future, "coordinator_host", None)),
+            "elapsed": round(elapsed * 1000, 3)
+        }
+        if self.cassandraTracing:
+            entry["traceIds"] = [str(trace_id) for trace_id
+                                 in future.get_query_trace_ids()]
+        self.queries.append(entry)
+        return entry
+
+    def record_page(self, entry, rows, elapsed):
+        entry["rows"] += len(rows.current_rows)
+        entry["pages"] += 1
+        entry["elapsed"] = round(entry["elapsed"] + elapsed * 1000, 3)
+
+    def record_batch(self, query, params, results, elapsed):
+        self.queries.append({
+            "statement": query.query_string,
+            "params": [[serialize_param(value) for value in values]
+                       for values in params],
+            "rows": sum(len(rows) for (_, rows) in results),
+            "pages": len(results),
+            "coordinator": None,
+            "elapsed": round(elapsed * 1000, 3)
+        })
+
+    def elapsed(self):
+        return round((time.time() - self.start) * 1000, 3)
+
+    def summary(self):
+        return "queries=%d; elapsed=%.3fms" % (len(self.queries),
+                                              self.elapsed())
+
+    def toJson(self):
+        return {
+            "elapsed": self.elapsed(),
+            "queryElapsed": round(sum(entry["elapsed"]
+                                      for entry in self.queries), 3),
+            "queries": self.queries
+        }
+
+
+def serialize_param(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    return str(value)
+
+
+def current_trace():
+    if has_request_context():
+        return g.get("trace")
+    return None
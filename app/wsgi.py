@@ -1,11 +1,19 @@
-from graphsenserest import app as application
-from graphsensedao import connect
+import gc
+from graphsenserest import app as application, start_warmup
+from graphsensedao import connect, preload
 from uwsgidecorators import postfork
 
+# exchange rates and block heights are loaded once before the workers are
+# forked; freezing keeps the garbage collector from touching shared pages
+preload(application)
+if hasattr(gc, "freeze"):
+    gc.freeze()
+
 
 @postfork
 def postfork_connect():
     connect(application)
+    start_warmup()
 
 
 if __name__ == "__main__":
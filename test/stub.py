@@ -0,0 +1,212 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
+
+app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, "app")
+if app_dir not in sys.path:
+    sys.path.insert(0, app_dir)
+
+import graphsensecache  # noqa: E402
+import graphsensedao as gd  # noqa: E402
+
+# In-memory replacement of the Cassandra session for tests without a
+# cluster. Tables map the names of the prepared statement dictionaries of
+# graphsensedao (e.g. "block_query") to functions of the bound values
+# returning the result rows.
+
+config = {
+    "SECRET_KEY": "test",
+    "CASSANDRA_NODES": ["localhost"],
+    "MAPPING": {"btc": ["btc_raw", "btc_transformed"]}
+}
+
+
+class StubRows(object):
+    def __init__(self, rows, fetch_size=None, paging_state=None):
+        self.rows = list(rows)
+        self.fetchSize = fetch_size or max(len(self.rows), 1)
+        self.position = int(paging_state) if paging_state else 0
+        self.response_future = SimpleNamespace(
+            coordinator_host="127.0.0.1", get_query_trace_ids=lambda: [])
+
+    @property
+    def current_rows(self):
+        return self.rows[self.position:self.position + self.fetchSize]
+
+    @property
+    def has_more_pages(self):
+        return self.position + self.fetchSize < len(self.rows)
+
+    @property
+    def paging_state(self):
+        # position of the next page, like the driver's opaque paging state
+        return str(self.position + self.fetchSize).encode() \
+            if self.has_more_pages else None
+
+    def fetch_next_page(self):
+        self.position += self.fetchSize
+
+    def one(self):
+        return self.current_rows[0] if self.current_rows else None
+
+    def __iter__(self):
+        return iter(self.rows[self.position:])
+
+    def __getitem__(self, i):
+        return self.current_rows[i]
+
+    def __bool__(self):
+        return bool(self.current_rows)
+
+
+class StubStatement(object):
+    def __init__(self, query_string, prepared=None, values=None):
+        self.query_string = query_string
+        self.prepared = prepared or self
+        self.values = values or []
+        self.fetch_size = None
+
+    def bind(self, values):
+        return StubStatement(self.query_string, self.prepared, list(values))
+
+
+class StubResponseFuture(object):
+    has_more_pages = False
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def add_callbacks(self, callback, errback):
+        callback(self.rows.rows)
+
+
+class StubSession(object):
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = []
+        self.cluster = SimpleNamespace(shutdown=lambda: None)
+
+    def prepare(self, query):
+        return StubStatement(query)
+
+    def execute(self, statement, params=None, **kwargs):
+        name = query_name(statement.prepared)
+        values = statement.values if params is None else list(params)
+        self.queries.append((name, values))
+        rows = self.tables.get(name, lambda values: [])(values)
+        return StubRows(rows, statement.fetch_size,
+                        kwargs.get("paging_state"))
+
+    def execute_async(self, statement, params=None, **kwargs):
+        return StubResponseFuture(self.execute(statement, params, **kwargs))
+
+
+def query_name(prepared):
+    for (name, queries) in vars(gd).items():
+        if name.endswith("_query") and isinstance(queries, dict) and \
+                any(query is prepared for query in queries.values()):
+            return name
+    return None
+
+
+def value(satoshi):
+    return SimpleNamespace(satoshi=satoshi, eur=satoshi * 1e-8,
+                           usd=satoshi * 2e-8)
+
+
+def tx_id(height):
+    return SimpleNamespace(height=height, tx_hash=bytes(32),
+                           timestamp=1231006505 + 600 * height)
+
+
+def block_row(height, no_transactions=1):
+    return SimpleNamespace(height=height, block_hash=bytes(32),
+                           no_transactions=no_transactions,
+                           timestamp=tx_id(height).timestamp)
+
+
+def cluster_row(cluster):
+    return SimpleNamespace(
+        cluster=cluster, first_tx=tx_id(1), last_tx=tx_id(2), no_addresses=5,
+        no_incoming_txs=1, no_outgoing_txs=2, total_received=value(1000),
+        total_spent=value(100), in_degree=1, out_degree=1)
+
+
+def cluster_relation_row(cluster, neighbor, direction, satoshi,
+                         no_transactions=1):
+    properties = SimpleNamespace(no_addresses=1, total_received=satoshi,
+                                 total_spent=0)
+    if direction == "in":
+        return SimpleNamespace(
+            dst_cluster=cluster, src_cluster=neighbor,
+            src_properties=properties, value=value(satoshi),
+            no_transactions=no_transactions)
+    return SimpleNamespace(
+        src_cluster=cluster, dst_cluster=neighbor, dst_properties=properties,
+        value=value(satoshi), no_transactions=no_transactions)
+
+
+def tag_row(address, cluster=None, tag="Binance hot wallet",
+            actor_category="exchange"):
+    return SimpleNamespace(
+        address=address, cluster=cluster, tag=tag,
+        tag_uri="https://example.com", description="exchange wallet",
+        actor_category=actor_category, source="example", source_uri=None,
+        timestamp=1)
+
+
+def text_keyed(rows):
+    # like the driver, which fails to serialize other types for text keys
+    def table(values):
+        if not isinstance(values[0], str):
+            raise TypeError("Received an argument of invalid type for "
+                            "column \"%s\"" % values[0])
+        return rows(values)
+    return table
+
+
+def chain_tables(height):
+    # exchange rates and blocks of a chain with blocks 0 to height
+    return {
+        "block_height_query":
+            lambda values: [SimpleNamespace(height=values[0])]
+            if values[0] <= height else [],
+        "exchange_rates_query":
+            lambda values: [{"height": h, "eur": 1.0, "usd": 2.0}
+                            for h in range(height + 1)]
+    }
+
+
+def connect(tables, height=10):
+    # replaces the session of graphsensedao and initializes currency btc
+    gd.session = StubSession(dict(chain_tables(height), **tables))
+    gd.currency_mapping = config["MAPPING"]
+    gd.preloaded.clear()
+    gd.tag_indexes.clear()
+    gd.bloom_filters.clear()
+    for name in ("address_cache", "cluster_cache", "balance_cache",
+                 "block_stats_cache", "block_timestamp_cache"):
+        setattr(gd, name, graphsensecache.LRUCache(0, 0))
+    for currency in gd.currency_mapping:
+        gd.currency_locks[currency] = threading.Lock()
+        gd.init_status[currency] = "pending"
+        gd.init_currency(currency)
+    return gd.session
+
+
+def rest_app():
+    # graphsenserest reads ./config.json on import
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "config.json"), "w") as fp:
+        json.dump(config, fp)
+    try:
+        os.chdir(directory)
+        import graphsenserest
+    finally:
+        os.chdir(cwd)
+    return graphsenserest.app
@@ -42,6 +42,13 @@ class FlaskBookshelfTests(unittest.TestCase):
     #    # assert the status code of the response
     #    self.assertEqual(result.status_code, 200)
 
+    def test_ready(self):
+        #"/ready"
+        result = self.app.get('/ready')
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.json['ready'])
+
     def test_block(self):
         # sends HTTP GET request to the application
         #"/<currency>/block/<int:height>"
@@ -84,18 +91,61 @@ class FlaskBookshelfTests(unittest.TestCase):
         # assert the status code of the response
         self.assertEqual(result.status_code, 200)
 
+    def test_blocks_range(self):
+        #"/<currency>/blocks?from=&to="
+        result = self.app.get('/btc/blocks?from=10&to=14')
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        heights = [block['height'] for block in result.json['blocks']]
+        self.assertEqual(heights, [10, 11, 12, 13, 14])
+
+    def test_block_stats(self):
+        #"/<currency>/blocks/stats?from=&to=&bucket="
+        result = self.app.get('/btc/blocks/stats?from=10&to=14&bucket=2')
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['blocks']['height'], [10, 11, 12, 13, 14])
+        self.assertEqual(len(result.json['buckets']), 3)
+        self.assertEqual(result.json['buckets'][0]['noBlocks'], 2)
+
     def test_tx_hash(self):
         # "/<currency>/tx/<txHash>"
         result = self.app.get('/btc/tx/%s' % self.txhash)
         # assert the status code of the response
         self.assertEqual(result.status_code, 200)
 
+    def test_tx_hash_resolved(self):
+        # "/<currency>/tx/<txHash>?resolve=cluster,tags"
+        result = self.app.get('/btc/tx/%s?resolve=cluster,tags' % self.txhash)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('cluster', result.json['outputs'][0])
+
     def test_search(self):
         #"/<currency>/search"
         result = self.app.get('/btc/search?q=1Arch')
         # assert the status code of the response
         self.assertEqual(result.status_code, 200)
 
+    def test_global_search(self):
+        #"/search"
+        result = self.app.get('/search?q=%s' % self.address)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['results'][0]['addresses'], [self.address])
+
+    def test_tag_search(self):
+        #"/<currency>/tags/search"
+        result = self.app.get('/btc/tags/search?q=exchange&field=actorCategory')
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertGreater(result.json['total'], 0)
+        for row in result.json['results']:
+            self.assertTrue('address' in row or 'cluster' in row)
+            self.assertTrue(any('exchange' in tag['actorCategory'].lower()
+                                for tag in row['tags']
+                                if tag['actorCategory']))
+
     def test_address(self):
         #"/<currency>/address/<address>"
         result = self.app.get('/btc/address/%s' % self.address)
@@ -114,6 +164,53 @@ class FlaskBookshelfTests(unittest.TestCase):
         # assert the status code of the response
         self.assertEqual(result.status_code, 200)
 
+    def test_address_transactions_expanded(self):
+        #"/<currency>/address/<address>/transactions?expand=tx"
+        result = self.app.get('/btc/address/%s/transactions?expand=tx' % self.address)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        transactions = result.json['transactions']
+        self.assertGreater(len(transactions), 0)
+        for tx in transactions:
+            self.assertEqual(tx['transaction']['txHash'], tx['txHash'])
+            self.assertEqual(tx['transaction']['height'], tx['height'])
+            addresses = [row['address'] for row
+                         in tx['transaction']['inputs'] +
+                         tx['transaction']['outputs']]
+            self.assertIn(self.address, addresses)
+
+    def test_address_balance(self):
+        #"/<currency>/address/<address>/balance"
+        result = self.app.get('/btc/address/%s/balance?height=500000' % self.address)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['address'], self.address)
+        self.assertEqual(result.json['height'], 500000)
+        self.assertGreaterEqual(result.json['balance']['satoshi'], 0)
+        # the balance at the latest block is the balance of the address
+        result = self.app.get('/btc/address/%s/balance' % self.address)
+        address = self.app.get('/btc/address/%s' % self.address).json
+        self.assertEqual(result.json['balance']['satoshi'],
+                         address['balance']['satoshi'])
+
+    def test_address_flows(self):
+        #"/<currency>/address/<address>/flows"
+        result = self.app.get('/btc/address/%s/flows?interval=month' % self.address)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['interval'], 'month')
+        flows = result.json['flows']
+        self.assertGreater(len(flows), 0)
+        timestamps = [flow['timestamp'] for flow in flows]
+        self.assertEqual(timestamps, sorted(timestamps))
+        if not result.json['truncated']:
+            address = self.app.get('/btc/address/%s' % self.address).json
+            # net flows of all transactions add up to the balance
+            self.assertEqual(
+                sum(flow['incoming']['satoshi'] - flow['outgoing']['satoshi']
+                    for flow in flows),
+                address['balance']['satoshi'])
+
     def test_address_tags(self):
         #"/<currency>/address/<address>/tags"
         result = self.app.get('/btc/address/%s/tags' % self.address)
@@ -150,6 +247,46 @@ class FlaskBookshelfTests(unittest.TestCase):
         # assert the status code of the response
         self.assertEqual(result.status_code, 200)
 
+    def test_address_neighbours_top(self):
+        #"/<currency>/address/<address>/neighbors?top=&sort="
+        result = self.app.get('/btc/address/%s/neighbors?direction=out&top=10&sort=transactions' % self.address)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        neighbors = result.json['neighbors']
+        self.assertTrue(0 < len(neighbors) <= 10)
+        transactions = [neighbor['noTransactions'] for neighbor in neighbors]
+        self.assertEqual(transactions, sorted(transactions, reverse=True))
+
+    def test_cluster_neighbours_tagged(self):
+        #"/<currency>/cluster/<cluster>/neighbors?tagged=true"
+        result = self.app.get('/btc/cluster/%s/neighbors?direction=in&tagged=true' % self.clusterId)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        for neighbor in result.json['neighbors']:
+            if neighbor['nodeType'] == 'cluster':
+                tags = self.app.get('/btc/cluster/%s/tags' % neighbor['id'])
+            else:
+                tags = self.app.get('/btc/address/%s/tags' % neighbor['id'])
+            self.assertTrue(tags.json)
+
+    def test_export(self):
+        #"/<currency>/export"
+        result = self.app.get('/btc/export?clusters=%s&depth=2&format=csv' % self.clusterId)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        lines = result.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'source,target,transactions,satoshi,eur,usd')
+        seed = str(self.clusterId)
+        self.assertTrue(any(seed in line.split(',')[:2] for line in lines[1:]))
+        self.assertNotIn('# truncated', lines)
+
+    def test_export_graphml(self):
+        #"/<currency>/export?format=graphml"
+        result = self.app.get('/btc/export?clusters=%s&direction=out' % self.clusterId)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('<node id="%s">' % self.clusterId, result.get_data(as_text=True))
+
     def test_cluster(self):
         #"/<currency>/cluster/<cluster>"
         result = self.app.get('/btc/cluster/%s' % self.clusterId)
@@ -174,6 +311,14 @@ class FlaskBookshelfTests(unittest.TestCase):
         # assert the status code of the response
         self.assertEqual(result.status_code, 200)
 
+    def test_cluster_addresses_top(self):
+        # "/<currency>/cluster/<cluster>/addresses/top"
+        result = self.app.get('/btc/cluster/%s/addresses/top?n=10&by=received' % self.clusterId)
+        # assert the status code of the response
+        self.assertEqual(result.status_code, 200)
+        received = [a['totalReceived']['satoshi'] for a in result.json['addresses']]
+        self.assertEqual(received, sorted(received, reverse=True))
+
     def test_cluster_egonet(self):
         # "/<currency>/cluster/<cluster>/egonet"
         result = self.app.get('/btc/cluster/%s/egonet' % self.clusterId)
@@ -0,0 +1,153 @@
+import gc
+import sys
+import threading
+import types
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import stub
+import graphsensebloom as gb
+import graphsensecache
+import graphsensedao as gd
+
+
+class DaoTests(unittest.TestCase):
+    def test_init_currency(self):
+        # init_currency runs the loaders while holding the currency lock
+        thread = threading.Thread(target=stub.connect, args=({}, 10),
+                                  daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(gd.init_status["btc"], "ready")
+        self.assertEqual(gd.last_height["btc"], 10)
+        self.assertEqual(gd.exchange_rate_arrays["btc"].shape, (11, 2))
+
+    def test_bloom_filter_guard(self):
+        session = stub.connect({})
+        bloom_filter = gb.BloomFilter.create(10, 0.001)
+        bloom_filter.add(b"1Known")
+        gd.bloom_filters[("btc", "address")] = bloom_filter
+        # unknown addresses are answered without a query
+        self.assertIsNone(gd.query_address("btc", "1Unknown"))
+        self.assertNotIn("address_query",
+                         [name for (name, _) in session.queries])
+        self.assertIsNone(gd.query_address("btc", "1Known"))
+        self.assertIn("address_query",
+                      [name for (name, _) in session.queries])
+        self.assertEqual(bloom_filter.falsePositives, 1)
+
+    def test_time_buckets(self):
+        # Monday 2024-01-01 00:00, Sunday 2024-01-07 23:59, Monday
+        # 2024-01-08 00:00 and Thursday 2024-02-01 00:00 UTC
+        timestamps = np.array([1704067200, 1704671999, 1704672000,
+                               1706745600])
+        self.assertEqual(
+            [str(day) for day in gd.time_buckets(timestamps, "day")],
+            ["2024-01-01", "2024-01-07", "2024-01-08", "2024-02-01"])
+        self.assertEqual(
+            [str(week) for week in gd.time_buckets(timestamps, "week")],
+            ["2024-01-01", "2024-01-01", "2024-01-08", "2024-01-29"])
+        self.assertEqual(
+            [str(month) for month in gd.time_buckets(timestamps, "month")],
+            ["2024-01", "2024-01", "2024-01", "2024-02"])
+
+    def test_address_flows(self):
+        rows = [(1704067200, 1, 10 ** 8), (1704671999, 2, -300),
+                (1704672000, 3, 50), (1706745600, 4, 10)]
+        stub.connect({"address_transactions_without_limit_query":
+                      lambda values: [SimpleNamespace(timestamp=timestamp,
+                                                      height=height,
+                                                      value=value)
+                                      for (timestamp, height, value)
+                                      in rows]})
+        (flows, truncated) = gd.query_address_flows("btc", "1A", "week")
+        self.assertFalse(truncated)
+        self.assertEqual(
+            [(flow["timestamp"], flow["fromHeight"], flow["toHeight"],
+              flow["noTransactions"], flow["incoming"]["satoshi"],
+              flow["outgoing"]["satoshi"]) for flow in flows],
+            [(1704067200, 1, 2, 2, 10 ** 8, 300),
+             (1704672000, 3, 3, 1, 50, 0),
+             (1706486400, 4, 4, 1, 10, 0)])
+        # valued at the exchange rates of the stub chain
+        self.assertEqual(flows[0]["incoming"]["usd"], 2.0)
+        (flows, _) = gd.query_address_flows("btc", "1A", "month")
+        self.assertEqual([flow["noTransactions"] for flow in flows], [3, 1])
+
+
+class BalanceTests(unittest.TestCase):
+    def setUp(self):
+        # one transaction of 10 times the height in each of blocks 1 to 10,
+        # checkpoints after every page of three of them
+        self.session = stub.connect({
+            "address_transactions_without_limit_query": self.transactions})
+        gd.balance_cache = graphsensecache.LRUCache(10, 60)
+        self.checkpoint_rows = gd.balance_checkpoint_rows
+        gd.balance_checkpoint_rows = 3
+        self.failing_page = None
+
+    def tearDown(self):
+        gd.balance_checkpoint_rows = self.checkpoint_rows
+
+    def transactions(self, values):
+        if len(self.session.queries) == self.failing_page:
+            raise gd.DeadlineExceeded()
+        return [SimpleNamespace(height=height, value=10 * height)
+                for height in range(1, 11)]
+
+    def balance(self, height):
+        del self.session.queries[:]
+        result = gd.query_address_balance("btc", "1A", height)
+        return (result["balance"]["satoshi"], result["noTransactions"],
+                result["truncated"], len(self.session.queries))
+
+    def test_checkpoints(self):
+        # stops at the first row above the height
+        self.assertEqual(self.balance(4), (100, 4, False, 2))
+        # starts at the checkpoint after the first page
+        self.assertEqual(self.balance(5), (150, 5, False, 1))
+        self.assertEqual(self.balance(2), (30, 2, False, 1))
+        self.assertEqual(self.balance(10), (550, 10, False, 3))
+        self.assertEqual(self.balance(9), (450, 9, False, 1))
+        # the complete scan is not repeated
+        self.assertEqual(self.balance(10), (550, 10, False, 0))
+        scan = gd.balance_cache.get(("btc", "1A"))
+        self.assertEqual(list(scan["heights"]), [-1, 3, 6, 9, 10])
+
+    def test_resume_truncated_scan(self):
+        self.failing_page = 3
+        self.assertEqual(self.balance(10), (210, 6, True, 3))
+        self.failing_page = None
+        # resumed after the pages scanned before
+        self.assertEqual(self.balance(10), (550, 10, False, 2))
+
+
+class PreloadTests(unittest.TestCase):
+    def test_import_wsgi(self):
+        # wsgi preloads all currencies in the uWSGI master at import
+        stub.rest_app()
+        cluster = mock.Mock()
+        cluster.return_value.connect.side_effect = \
+            lambda: stub.StubSession(stub.chain_tables(10))
+        uwsgidecorators = types.ModuleType("uwsgidecorators")
+        uwsgidecorators.postfork = lambda f: f
+        gd.preloaded.clear()
+        sys.modules.pop("wsgi", None)
+        with mock.patch("cassandra.cluster.Cluster", cluster), \
+                mock.patch.dict(sys.modules,
+                                {"uwsgidecorators": uwsgidecorators}):
+            thread = threading.Thread(target=__import__, args=("wsgi",),
+                                      daemon=True)
+            thread.start()
+            thread.join(10)
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(gd.preloaded, {"btc"})
+        self.assertEqual(gd.last_height["btc"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
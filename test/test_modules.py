@@ -0,0 +1,340 @@
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+import stub  # noqa: F401
+import graphsenseadmission as gad
+import graphsensearchive as ga
+import graphsensebloom as gb
+import graphsensecache as gc
+import graphsenseflight as gf
+import graphsensestore as gs
+
+
+class AdmissionTests(unittest.TestCase):
+    def test_is_expensive(self):
+        self.assertTrue(gad.is_expensive("cluster_egonet", {}, 1000))
+        self.assertFalse(gad.is_expensive("cluster", {}, 1000))
+        self.assertTrue(gad.is_expensive("cluster", {"resolve": "tags"}, 1000))
+        self.assertFalse(gad.is_expensive("cluster_neighbors",
+                                          {"pagesize": "100"}, 1000))
+        self.assertTrue(gad.is_expensive("cluster_neighbors",
+                                         {"pagesize": "5000"}, 1000))
+        self.assertTrue(gad.is_expensive("cluster_neighbors",
+                                         {"top": "10"}, 1000))
+        self.assertTrue(gad.is_expensive("blocks", {"from": "0"}, 1000))
+        self.assertFalse(gad.is_expensive("blocks",
+                                          {"from": "0", "to": "10"}, 1000))
+        self.assertFalse(gad.is_expensive("blocks", {"from": "x"}, 1000))
+
+    def acquire_waiting(self, admission, client):
+        # acquires in a thread, returning once the request waits
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(admission.acquire(client)))
+        thread.start()
+        while admission.waiting < 1:
+            time.sleep(0.001)
+        return thread, results
+
+    def test_acquire_release(self):
+        admission = gad.AdmissionController(2, 2, 1, 5)
+        self.assertTrue(admission.acquire("a"))
+        self.assertTrue(admission.acquire("b"))
+        self.assertEqual(admission.running, 2)
+        admission.release("a")
+        admission.release("b")
+        self.assertEqual(admission.running, 0)
+        self.assertEqual(admission.clients, {})
+
+    def test_client_requests_wait(self):
+        admission = gad.AdmissionController(2, 1, 1, 5)
+        self.assertTrue(admission.acquire("a"))
+        (thread, results) = self.acquire_waiting(admission, "a")
+        # other clients are served meanwhile
+        self.assertTrue(admission.acquire("b"))
+        admission.release("b")
+        admission.release("a")
+        thread.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(admission.clients, {"a": 1})
+
+    def test_full_queue_rejects(self):
+        admission = gad.AdmissionController(1, 1, 1, 5)
+        self.assertTrue(admission.acquire("a"))
+        (thread, results) = self.acquire_waiting(admission, "b")
+        start = time.time()
+        self.assertFalse(admission.acquire("c"))
+        self.assertLess(time.time() - start, 1)
+        admission.release("a")
+        thread.join(5)
+        self.assertEqual(results, [True])
+
+    def test_queue_timeout(self):
+        admission = gad.AdmissionController(1, 1, 1, 0.05)
+        self.assertTrue(admission.acquire("a"))
+        self.assertFalse(admission.acquire("b"))
+        self.assertEqual(admission.waiting, 0)
+        self.assertEqual(admission.clients, {"a": 1})
+
+
+class BloomFilterTests(unittest.TestCase):
+    def setUp(self):
+        self.filter = gb.BloomFilter.create(1000, 0.001)
+        for i in range(1000):
+            self.filter.add(b"known%d" % i)
+
+    def test_membership(self):
+        self.assertTrue(all(b"known%d" % i in self.filter
+                            for i in range(1000)))
+        false_positives = sum(self.filter.might_contain(b"unknown%d" % i)
+                              for i in range(10000))
+        self.assertLess(false_positives, 50)
+        self.assertEqual(self.filter.toJson()["definiteMisses"],
+                         10000 - false_positives)
+        self.assertAlmostEqual(self.filter.false_positive_rate(), 0.001,
+                               delta=0.0005)
+
+    def test_save_load(self):
+        path = os.path.join(tempfile.mkdtemp(), "btc_address.bloom")
+        self.filter.height = 42
+        self.filter.save(path)
+        loaded = gb.BloomFilter.load(path)
+        self.assertEqual((loaded.bits, loaded.hashes, loaded.items,
+                          loaded.height),
+                         (self.filter.bits, self.filter.hashes, 1000, 42))
+        self.assertIn(b"known7", loaded)
+        with open(path, "r+b") as fp:
+            fp.write(b"GSBLOOM0")
+        with self.assertRaises(ValueError):
+            gb.BloomFilter.load(path)
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_eviction(self):
+        cache = gc.LRUCache(2, 60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # b is the least recently used entry
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_expiry(self):
+        cache = gc.LRUCache(2, 0)
+        cache.put("a", 1)
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.toJson()["size"], 0)
+
+    def test_disabled(self):
+        cache = gc.LRUCache(0, 60)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+class HotPathsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as fp:
+            fp.write("".join(line + "\n" for line in lines))
+        return path
+
+    def test_hot_paths(self):
+        access_log = self.write("access.log", [
+            '127.0.0.1 - - "GET /btc/address/1A HTTP/1.1" 200',
+            '127.0.0.1 - - "GET /btc/block/5 HTTP/1.1" 200',
+            '127.0.0.1 - - "GET /btc/address/1A HTTP/1.1" 200',
+            '127.0.0.1 - - "POST /btc/address/1B HTTP/1.1" 200',
+            'GET /btc/cluster/7 => generated 100 bytes'])
+        hot_keys = self.write("hot_keys", [
+            "# deployed with the release", "/btc/cluster/7", ""])
+        self.assertEqual(gc.hot_paths([access_log], hot_keys, 10, 2**20),
+                         ["/btc/cluster/7", "/btc/address/1A",
+                          "/btc/block/5"])
+        self.assertEqual(gc.hot_paths([access_log], None, 1, 2**20),
+                         ["/btc/address/1A"])
+        self.assertEqual(
+            gc.hot_paths([access_log], None, 10, 2**20,
+                         lambda path: "/block/" not in path),
+            ["/btc/address/1A", "/btc/cluster/7"])
+
+    def test_tail_of_large_logs(self):
+        access_log = self.write("access.log", [
+            '"GET /btc/address/1Old HTTP/1.1"'] * 10 +
+            ['"GET /btc/address/1New HTTP/1.1"'])
+        self.assertEqual(gc.hot_paths([access_log], None, 10, 40),
+                         ["/btc/address/1New"])
+
+
+class MaterializedStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.store = gs.MaterializedStore(
+            os.path.join(tempfile.mkdtemp(), "materialized.db"))
+
+    def test_latest_build(self):
+        key = gs.store_key("/btc/cluster/5/egonet")
+        self.store.replace("btc", 12, [(key, b"{}", "application/json")])
+        self.assertEqual(self.store.get("btc", key, 10),
+                         (b"{}", "application/json"))
+        self.assertEqual(self.store.get("btc", key, 12),
+                         (b"{}", "application/json"))
+        # older than the height loaded by the worker
+        self.assertIsNone(self.store.get("btc", key, 13))
+
+    def test_replace(self):
+        self.store.replace("btc", 12, [("a?", b"1", "text/plain")])
+        self.store.replace("btc", 14, [("b?", b"2", "text/plain")])
+        self.assertEqual(self.store.height("btc"), 14)
+        self.assertIsNone(self.store.get("btc", "a?", 0))
+        self.assertEqual(self.store.get("btc", "b?", 0),
+                         (b"2", "text/plain"))
+
+
+class ResponseArchiveTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_lookup(self):
+        archive = ga.ResponseArchive(self.directory, 10000, True)
+        archive.put("btc", "block", "1f", b'{"height": 31}')
+        (path, encoding) = archive.lookup("btc", "block", "1f", True)
+        self.assertEqual(encoding, "gzip")
+        with open(path, "rb") as fp:
+            self.assertEqual(gzip.decompress(fp.read()), b'{"height": 31}')
+        (path, encoding) = archive.lookup("btc", "block", "1f", False)
+        self.assertIsNone(encoding)
+        self.assertIsNone(archive.lookup("btc", "block", "2f", False))
+        self.assertIsNone(archive.lookup("btc", "block", "../1f", False))
+
+    def test_size_shared_by_workers(self):
+        workers = [ga.ResponseArchive(self.directory, 500, False)
+                   for _ in range(2)]
+        for i in range(20):
+            workers[i % 2].put("btc", "block", "%x" % i, b"x" * 100)
+            size = sum(os.path.getsize(path)
+                       for (path, _, _) in workers[0].files())
+            self.assertLessEqual(size, 500)
+            self.assertEqual(workers[i % 2].toJson()["size"], size)
+
+    def test_size_of_existing_archive(self):
+        ga.ResponseArchive(self.directory, 500, False).put(
+            "btc", "block", "1", b"x" * 100)
+        self.assertEqual(
+            ga.ResponseArchive(self.directory, 500, False).toJson()["size"],
+            100)
+
+
+class SingleFlightTests(unittest.TestCase):
+    def call_concurrently(self, flights, leader, followers):
+        # the leader computes until all followers wait for it
+        started = threading.Event()
+        release = threading.Event()
+        results = [None] * (1 + len(followers))
+
+        def lead():
+            started.set()
+            release.wait(5)
+            return leader()
+
+        def call(i, compute):
+            try:
+                results[i] = flights.do("key", compute, lambda: 5)
+            except RuntimeError as e:
+                results[i] = e
+        threads = [threading.Thread(target=call, args=(0, lead))]
+        threads[0].start()
+        started.wait(5)
+        threads += [threading.Thread(target=call, args=(i + 1, compute))
+                    for (i, compute) in enumerate(followers)]
+        for thread in threads[1:]:
+            thread.start()
+        while flights.coalesced < len(followers):
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalesce(self):
+        flights = gf.SingleFlight()
+        results = self.call_concurrently(
+            flights, lambda: "leader", [lambda: "follower"] * 2)
+        self.assertEqual(results, ["leader"] * 3)
+        self.assertEqual(flights.leaders, 1)
+
+    def test_retry_after_leader_failure(self):
+        def fail():
+            raise RuntimeError("timeout")
+        flights = gf.SingleFlight()
+        results = self.call_concurrently(flights, fail, [lambda: "follower"])
+        self.assertIsInstance(results[0], RuntimeError)
+        self.assertEqual(results[1], "follower")
+        self.assertEqual(flights.retried, 1)
+
+    def test_shared_across_workers(self):
+        directory = tempfile.mkdtemp()
+        workers = [gf.SingleFlight(directory), gf.SingleFlight(directory)]
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def lead():
+            started.set()
+            release.wait(5)
+            return "leader"
+        leader = threading.Thread(target=lambda: results.append(
+            workers[0].do("key", lead, lambda: 5)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(
+            workers[1].do("key", lambda: "follower", lambda: 5)))
+        follower.start()
+        # only requests of the same key wait for the leader
+        self.assertEqual(workers[1].do("other", lambda: "other", lambda: 5),
+                         "other")
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(results, ["leader", "leader"])
+        self.assertEqual(workers[1].shared, 1)
+
+    def test_stale_lock(self):
+        directory = tempfile.mkdtemp()
+        flights = gf.SingleFlight(directory)
+        name = hashlib.sha1(repr("key").encode("utf-8")).hexdigest()
+        lock_path = os.path.join(directory, name + ".lock")
+        open(lock_path, "w").close()
+        os.utime(lock_path, (0, 0))
+        self.assertEqual(flights.do("key", lambda: "result", lambda: 5),
+                         "result")
+        self.assertFalse(os.path.exists(lock_path))
+
+    def test_cleanup(self):
+        directory = tempfile.mkdtemp()
+        flights = gf.SingleFlight(directory)
+        self.assertEqual(flights.do("key", lambda: "result", lambda: 5),
+                         "result")
+        self.assertEqual(len(os.listdir(directory)), 1)
+        for (name, age) in (("old", gf.CLEANUP_INTERVAL + 1),
+                            ("held.lock", gf.CLEANUP_INTERVAL + 1),
+                            ("stale.lock", gf.LOCK_TIMEOUT + 1)):
+            path = os.path.join(directory, name)
+            open(path, "w").close()
+            os.utime(path, (time.time() - age, time.time() - age))
+        flights.lastCleanup = 0
+        flights.cleanup()
+        self.assertEqual(len(os.listdir(directory)), 2)
+        self.assertIn("held.lock", os.listdir(directory))
+
+
+if __name__ == "__main__":
+    unittest.main()
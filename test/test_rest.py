@@ -0,0 +1,515 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from cassandra import OperationTimedOut
+import stub
+import graphsenseadmission as ga
+import graphsensecache as gc
+import graphsensedao as gd
+import graphsensestore as gs
+
+app = stub.rest_app()
+import graphsenserest  # noqa: E402
+
+
+def cluster_tables():
+    return {
+        "cluster_query": lambda values: [stub.cluster_row(values[0])],
+        "cluster_incoming_relations_query": stub.text_keyed(
+            lambda values: [stub.cluster_relation_row(values[0], "1001",
+                                                      "in", 500)]),
+        "cluster_incoming_relations_without_limit_query": stub.text_keyed(
+            lambda values: [
+                stub.cluster_relation_row(values[0], "1001", "in", 500, 3),
+                stub.cluster_relation_row(values[0], "1002", "in", 900, 1),
+                stub.cluster_relation_row(values[0], "1Addr", "in", 300, 2)]),
+        "cluster_outgoing_relations_query": stub.text_keyed(
+            lambda values: [stub.cluster_relation_row(
+                values[0], str(int(values[0]) + 1), "out", 700)]),
+        "all_cluster_tags_query":
+            lambda values: [stub.tag_row("1Tagged", 1001)]
+    }
+
+
+def block_tables(height):
+    return {
+        "block_query": lambda values: [stub.block_row(values[0])]
+        if values[0] <= height else [],
+        "address_transactions_without_limit_query": lambda values: [
+            SimpleNamespace(height=2, value=1000),
+            SimpleNamespace(height=5, value=-300),
+            SimpleNamespace(height=5, value=50)]
+    }
+
+
+def block_stats_tables():
+    # two transactions per block, with inputs of 100 and outputs of 90
+    # satoshi times the height
+    return dict(block_tables(10), block_transactions_query=lambda values: [
+        SimpleNamespace(txs=[SimpleNamespace(total_input=100 * values[0],
+                                             total_output=90 * values[0])] * 2)
+    ])
+
+
+class RestTests(unittest.TestCase):
+    def setUp(self):
+        graphsenserest.response_cache = gc.LRUCache(0, 0)
+        self.session = stub.connect(cluster_tables())
+        self.app = app.test_client()
+
+    def test_cluster_egonet(self):
+        result = self.app.get('/btc/cluster/5/egonet')
+        self.assertEqual(result.status_code, 200)
+        ids = sorted(str(node['id']) for node in result.json['nodes'])
+        self.assertEqual(ids, ['1001', '5', '6'])
+        self.assertEqual(len(result.json['edges']), 2)
+
+    def test_cluster_egonet_not_found(self):
+        self.session.tables["cluster_query"] = lambda values: []
+        result = self.app.get('/btc/cluster/5/egonet')
+        self.assertEqual(result.status_code, 404)
+
+    def test_cluster_neighbors_top(self):
+        result = self.app.get('/btc/cluster/5/neighbors?direction=in&top=2')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([row['id'] for row in result.json['neighbors']],
+                         ['1002', '1001'])
+        self.assertFalse(result.json['truncated'])
+        result = self.app.get(
+            '/btc/cluster/5/neighbors?direction=in&sort=transactions&top=2')
+        self.assertEqual([row['id'] for row in result.json['neighbors']],
+                         ['1001', '1Addr'])
+
+    def test_cluster_neighbors_tagged(self):
+        result = self.app.get(
+            '/btc/cluster/5/neighbors?direction=in&tagged=true')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([row['id'] for row in result.json['neighbors']],
+                         ['1001'])
+
+    def test_empty_response_not_cached(self):
+        graphsenserest.response_cache = gc.LRUCache(10, 60)
+        self.session.tables["cluster_query"] = lambda values: []
+        result = self.app.get('/btc/cluster/5')
+        self.assertEqual(result.json, {})
+        self.assertEqual(len(graphsenserest.response_cache.entries), 0)
+        self.session.tables["cluster_query"] = cluster_tables()["cluster_query"]
+        result = self.app.get('/btc/cluster/5')
+        self.assertEqual(result.json['cluster'], 5)
+        self.assertEqual(len(graphsenserest.response_cache.entries), 1)
+
+    def test_address_egonet_not_found(self):
+        result = self.app.get('/btc/address/1Missing/egonet')
+        self.assertEqual(result.status_code, 404)
+
+    def test_address_balance(self):
+        self.session.tables.update(block_tables(10))
+        result = self.app.get('/btc/address/1A/balance?height=4')
+        self.assertEqual(result.json['balance']['satoshi'], 1000)
+        self.assertEqual(result.json['noTransactions'], 1)
+        timestamp = stub.block_row(5).timestamp + 10
+        result = self.app.get('/btc/address/1A/balance?timestamp=%d'
+                              % timestamp)
+        self.assertEqual(result.json['height'], 5)
+        self.assertEqual(result.json['balance']['satoshi'], 750)
+        self.assertEqual(result.json['noTransactions'], 3)
+        self.assertFalse(result.json['truncated'])
+
+    def test_address_balance_missing_block(self):
+        # blocks up to height 10 are announced, 8 to 10 are not ingested yet
+        self.session.tables.update(block_tables(7))
+        result = self.app.get('/btc/address/1A/balance?timestamp=%d'
+                              % stub.block_row(9).timestamp)
+        self.assertEqual(result.status_code, 404)
+
+    def test_block_stats(self):
+        self.session.tables.update(block_stats_tables())
+        result = self.app.get('/btc/blocks/stats?from=2&to=7&bucket=4')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['blocks']['height'], [2, 3, 4, 5, 6, 7])
+        self.assertEqual(result.json['blocks']['totalInput']['satoshi'],
+                         [400, 600, 800, 1000, 1200, 1400])
+        buckets = result.json['buckets']
+        self.assertEqual([(b['fromHeight'], b['toHeight'], b['noBlocks'])
+                          for b in buckets], [(2, 3, 2), (4, 7, 4)])
+        self.assertEqual([b['noTransactions'] for b in buckets], [2, 4])
+        self.assertEqual([b['totalOutput']['satoshi'] for b in buckets],
+                         [900, 3960])
+
+    def test_block_stats_batches(self):
+        self.session.tables.update(block_stats_tables())
+        result = self.app.get('/btc/blocks/stats?from=2&to=7&bucket=4')
+        del self.session.queries[:]
+        concurrency = stub.gd.concurrency
+        stub.gd.concurrency = 4
+        try:
+            batched = self.app.get('/btc/blocks/stats?from=2&to=7&bucket=4')
+        finally:
+            stub.gd.concurrency = concurrency
+        self.assertEqual(batched.json, result.json)
+        # the transactions of a batch are fetched before the next blocks
+        self.assertEqual(
+            [(name, values[0]) for (name, values) in self.session.queries],
+            [("block_query", height) for height in range(2, 6)] +
+            [("block_transactions_query", height) for height in range(2, 6)] +
+            [("block_query", height) for height in range(6, 8)] +
+            [("block_transactions_query", height) for height in range(6, 8)])
+
+    def test_block_stats_cached_buckets(self):
+        self.session.tables.update(block_stats_tables())
+        stub.gd.block_stats_cache = gc.LRUCache(10, float("inf"))
+        self.app.get('/btc/blocks/stats?from=2&to=7&bucket=4')
+        del self.session.queries[:]
+        result = self.app.get('/btc/blocks/stats?from=4&to=9&bucket=4')
+        self.assertEqual(result.json['blocks']['height'], [4, 5, 6, 7, 8, 9])
+        # only the blocks of the incomplete bucket are queried
+        self.assertEqual(sorted(values[0] for (name, values)
+                                in self.session.queries
+                                if name == "block_query"), [8, 9])
+
+    def test_block_stats_timestamps(self):
+        self.session.tables.update(block_stats_tables())
+
+        def heights(query):
+            result = self.app.get('/btc/blocks/stats?' + query)
+            return (result.json['fromHeight'], result.json['toHeight'])
+        timestamp = stub.block_row(3).timestamp
+        self.assertEqual(
+            heights('fromTimestamp=%d&toTimestamp=%d'
+                    % (timestamp, timestamp + 1200)), (3, 5))
+        self.assertEqual(
+            heights('fromTimestamp=%d&to=5' % (timestamp + 1)), (4, 5))
+        self.assertEqual(
+            heights('fromTimestamp=0&to=1'), (0, 1))
+        result = self.app.get('/btc/blocks/stats?fromTimestamp=%d'
+                              % (stub.block_row(10).timestamp + 1))
+        self.assertEqual(result.status_code, 404)
+
+    def test_tag_search(self):
+        stub.connect(dict(cluster_tables(), all_address_tags_query=lambda _: [
+            stub.tag_row("1Exchange", tag="Kraken deposit"),
+            stub.tag_row("1Shop", tag="Coffee shop",
+                         actor_category="merchant")]))
+        result = self.app.get('/btc/tags/search?q=exch&field=actorCategory')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json['total'], 2)
+        self.assertEqual([row.get('address', row.get('cluster'))
+                          for row in result.json['results']],
+                         ['1Exchange', 1001])
+        self.assertIsNone(result.json['nextPage'])
+        result = self.app.get('/btc/tags/search?q=coffee%20sh&pagesize=1')
+        self.assertEqual(result.json['results'][0]['address'], '1Shop')
+        self.assertEqual(result.json['results'][0]['tags'][0]['tag'],
+                         'Coffee shop')
+        result = self.app.get('/btc/tags/search?q=wallet&pagesize=1')
+        self.assertEqual(result.json['total'], 3)
+        self.assertEqual(result.json['nextPage'], '1')
+        result = self.app.get('/btc/tags/search?q=exchange&field=uri')
+        self.assertEqual(result.status_code, 404)
+
+    def test_global_search_unavailable_currency(self):
+        self.session.tables["address_search_query"] = lambda values: [
+            SimpleNamespace(address="1Archive")]
+        gd.init_status["btc"] = "deferred"
+        result = self.app.get('/search?q=1Archi')
+        self.assertEqual(result.json, {"results": [], "incomplete": ["btc"]})
+        # initialized in the background for later searches
+        for _ in range(500):
+            if gd.init_status["btc"] == "ready":
+                break
+            time.sleep(0.01)
+        result = self.app.get('/search?q=1Archi')
+        self.assertEqual(result.json['incomplete'], [])
+        self.assertEqual(result.json['results'][0]['addresses'],
+                         ["1Archive"])
+
+    def test_address_transactions_expanded(self):
+        hashes = [bytes([1]) * 32, bytes([2]) * 32]
+        self.session.tables.update({
+            "address_transactions_without_limit_query": lambda values: [
+                SimpleNamespace(address=values[0], address_prefix=values[1],
+                                tx_hash=tx_hash, value=1000, height=height,
+                                timestamp=stub.tx_id(height).timestamp,
+                                tx_index=height)
+                for (height, tx_hash) in enumerate(hashes, 2)],
+            # the second transaction is missing
+            "tx_query": lambda values: [SimpleNamespace(
+                tx_hash=values[1], coinbase=False, height=2,
+                inputs=[SimpleNamespace(address=["1In"], value=1200)],
+                outputs=[SimpleNamespace(address=["1A"], value=1000)],
+                timestamp=stub.tx_id(2).timestamp, total_input=1200,
+                total_output=1000)] if values[1] == hashes[0] else []
+        })
+        result = self.app.get('/btc/address/1A/transactions?expand=tx')
+        self.assertEqual(result.status_code, 200)
+        (first, second) = result.json['transactions']
+        self.assertEqual(first['transaction']['txHash'], first['txHash'])
+        self.assertEqual(first['transaction']['outputs'],
+                         [{'address': '1A', 'value': {
+                             'satoshi': 1000, 'eur': 0.0, 'usd': 0.0}}])
+        self.assertIsNone(second['transaction'])
+        result = self.app.get('/btc/address/1A/transactions')
+        self.assertNotIn('transaction', result.json['transactions'][0])
+        result = self.app.get('/btc/address/1A/transactions?expand=tags')
+        self.assertEqual(result.status_code, 404)
+
+    def test_export_csv(self):
+        # a chain 5 -> 6 -> 7 -> 8 of clusters
+        result = self.app.get(
+            '/btc/export?clusters=5&depth=3&direction=out&format=csv')
+        self.assertEqual(result.status_code, 200)
+        lines = result.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'source,target,transactions,satoshi,eur,usd')
+        self.assertEqual([line.split(',')[:2] for line in lines[1:]],
+                         [['5', '6'], ['6', '7'], ['7', '8']])
+
+    def test_export_truncated(self):
+        app.config["MAX_EXPORT_NODES"] = 2
+        try:
+            result = self.app.get(
+                '/btc/export?clusters=5&depth=3&direction=out&format=csv')
+        finally:
+            del app.config["MAX_EXPORT_NODES"]
+        lines = result.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-1], '# truncated')
+
+    def test_export_graphml(self):
+        result = self.app.get('/btc/export?clusters=5&direction=out')
+        self.assertEqual(result.status_code, 200)
+        data = result.get_data(as_text=True)
+        self.assertIn('<node id="5">', data)
+        self.assertIn('<edge source="5" target="6">', data)
+        self.assertNotIn('truncated', data)
+
+    def test_export_errors(self):
+        # raised before streaming starts
+        result = self.app.get('/xyz/export?clusters=5&format=csv')
+        self.assertEqual(result.status_code, 404)
+        self.session.tables["cluster_query"] = lambda values: []
+        result = self.app.get('/btc/export?clusters=5&format=csv')
+        self.assertEqual(result.status_code, 404)
+
+    def test_admission_rejected(self):
+        admission = graphsenserest.admission
+        graphsenserest.admission = ga.AdmissionController(1, 1, 0, 0)
+        try:
+            graphsenserest.admission.acquire("other")
+            result = self.app.get('/btc/cluster/5/egonet')
+            self.assertEqual(result.status_code, 429)
+            self.assertEqual(result.headers['Retry-After'], '5')
+            # cheap requests are not limited
+            self.assertEqual(self.app.get('/btc/cluster/5').status_code, 200)
+            graphsenserest.admission.release("other")
+            result = self.app.get('/btc/cluster/5/egonet')
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(graphsenserest.admission.running, 0)
+        finally:
+            graphsenserest.admission = admission
+
+    def request_deadline(self, headers=None):
+        # the seconds left when the cluster is queried
+        remaining = []
+        self.session.tables["cluster_query"] = lambda values: \
+            remaining.append(gd.remaining_time()) or \
+            [stub.cluster_row(values[0])]
+        result = self.app.get('/btc/cluster/5', headers=headers or {})
+        return result.status_code, remaining
+
+    def test_request_deadline(self):
+        (status, remaining) = self.request_deadline()
+        self.assertEqual(status, 200)
+        self.assertTrue(29 < remaining[0] <= 30)
+        app.config["REQUEST_DEADLINES"] = {"cluster": 5}
+        try:
+            (_, remaining) = self.request_deadline()
+            self.assertTrue(4 < remaining[0] <= 5)
+        finally:
+            del app.config["REQUEST_DEADLINES"]
+
+    def test_request_deadline_header(self):
+        (_, remaining) = self.request_deadline({"X-Request-Deadline": "2"})
+        self.assertTrue(1 < remaining[0] <= 2)
+        # capped at MAX_REQUEST_DEADLINE
+        (_, remaining) = self.request_deadline(
+            {"X-Request-Deadline": "1000"})
+        self.assertTrue(59 < remaining[0] <= 60)
+        (status, remaining) = self.request_deadline(
+            {"X-Request-Deadline": "soon"})
+        self.assertEqual(status, 404)
+        self.assertEqual(remaining, [])
+
+    def test_deadline_exceeded(self):
+        for error in (gd.DeadlineExceeded(), OperationTimedOut()):
+            def cluster_query(values, error=error):
+                raise error
+            self.session.tables["cluster_query"] = cluster_query
+            result = self.app.get('/btc/cluster/5')
+            self.assertEqual(result.status_code, 504)
+            self.assertEqual(result.json['message'],
+                             'Request deadline exceeded')
+
+    def test_deadline_stops_concurrent_queries(self):
+        self.session.tables.update(block_stats_tables())
+        result = self.app.get('/btc/blocks/stats?from=2&to=7',
+                              headers={"X-Request-Deadline": "0"})
+        self.assertEqual(result.status_code, 504)
+        self.assertNotIn("block_query",
+                         [name for (name, _) in self.session.queries])
+
+    def test_materialized_store(self):
+        # built at a newer height than the worker loaded
+        store = gs.MaterializedStore(
+            os.path.join(tempfile.mkdtemp(), "materialized.db"))
+        store.replace("btc", 12, [(gs.store_key("/btc/cluster/5/egonet"),
+                                   b'{"stored": true}', "application/json")])
+        graphsenserest.store = store
+        try:
+            result = self.app.get('/btc/cluster/5/egonet')
+        finally:
+            graphsenserest.store = None
+        self.assertEqual(result.json, {"stored": True})
+
+
+class HeldResponseFuture(object):
+    # driver request answered once release is called
+    has_more_pages = False
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.lock = threading.Lock()
+        self.released = False
+        self.callback = None
+
+    def add_callbacks(self, callback, errback):
+        with self.lock:
+            self.callback = callback
+            released = self.released
+        if released:
+            callback(self.rows)
+
+    def release(self):
+        with self.lock:
+            self.released = True
+            callback = self.callback
+        if callback is not None:
+            callback(self.rows)
+
+
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        graphsenserest.response_cache = gc.LRUCache(0, 0)
+        self.session = stub.connect(cluster_tables())
+
+    async def call(self, path, query=b"", headers=()):
+        import graphsenseasync
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": path,
+                 "query_string": query,
+                 "headers": [(name.encode(), value.encode())
+                             for (name, value) in headers]}
+        await graphsenseasync.application(scope, receive, send)
+        body = b"".join(message.get("body", b"") for message in messages)
+        return messages[0]["status"], body
+
+    def request(self, path, query=b"", headers=()):
+        return asyncio.run(self.call(path, query, headers))
+
+    def hold_responses(self, count):
+        # driver requests are answered once count of them are in flight
+        held = []
+        execute = self.session.execute
+
+        def execute_async(statement, params=None, **kwargs):
+            future = HeldResponseFuture(execute(statement, params).rows)
+            held.append(future)
+            if len(held) == count:
+                for future in held:
+                    threading.Thread(target=future.release).start()
+            return future
+        self.session.execute_async = execute_async
+
+    def test_coroutine_views(self):
+        # far more requests in flight than threads in the pool
+        import graphsenseasync
+        requests = 4 * graphsenseasync.executor._max_workers
+        self.hold_responses(requests)
+
+        async def call_all():
+            return await asyncio.wait_for(asyncio.gather(
+                *[self.call('/btc/cluster/%d' % i)
+                  for i in range(requests)]), 10)
+        responses = asyncio.run(call_all())
+        self.assertEqual([json.loads(body)['cluster']
+                          for (_, body) in responses], list(range(requests)))
+
+    def test_request_hooks(self):
+        graphsenserest.response_cache = gc.LRUCache(10, 60)
+        (status, body) = self.request('/btc/cluster/5')
+        self.assertEqual(json.loads(body)['cluster'], 5)
+        queries = len(self.session.queries)
+        (status, cached) = self.request('/btc/cluster/5')
+        self.assertEqual(cached, body)
+        self.assertEqual(len(self.session.queries), queries)
+        (status, _) = self.request('/xyz/cluster/5')
+        self.assertEqual(status, 404)
+
+    def test_deadline(self):
+        self.hold_responses(1000)
+        (status, body) = self.request('/btc/cluster/5', b"",
+                                      [("X-Request-Deadline", "0.05")])
+        self.assertEqual(status, 504)
+
+    def test_admission(self):
+        admission = graphsenserest.admission
+        running = []
+        self.session.tables["cluster_query"] = lambda values: \
+            running.append(admission.running) or \
+            [stub.cluster_row(values[0])]
+        (status, _) = self.request('/btc/cluster/5/egonet')
+        self.assertEqual(status, 200)
+        # held while the coroutine runs, released afterwards
+        self.assertEqual(running, [1])
+        self.assertEqual(admission.running, 0)
+
+    def test_search(self):
+        self.session.tables.update({
+            "address_search_query": lambda values: [
+                SimpleNamespace(address="1Archive"),
+                SimpleNamespace(address="1ArchX")],
+            "transaction_search_query": lambda values: []
+        })
+        (status, body) = self.request('/btc/search', b"q=1Archi")
+        self.assertEqual(json.loads(body),
+                         {"addresses": ["1Archive"], "transactions": []})
+        (status, body) = self.request('/search', b"q=1Archi")
+        self.assertEqual(json.loads(body)['results'],
+                         [{"currency": "btc", "addresses": ["1Archive"],
+                           "transactions": []}])
+
+    def test_cluster_egonet(self):
+        # served by the Flask views and hooks
+        (status, body) = self.request('/btc/cluster/5/egonet',
+                                      b"direction=in")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)['nodes']), 2)
+
+    def test_not_found(self):
+        (status, _) = self.request('/btc/cluster/x/egonet')
+        self.assertEqual(status, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()